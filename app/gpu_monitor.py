@@ -1,6 +1,5 @@
 import threading
 import time
-import pynvml
 from app.metrics import GPU_UTILIZATION
 
 class GPUMonitor:
@@ -18,6 +17,7 @@ class GPUMonitor:
     def start(self):
         """Start the GPU monitoring thread."""
         try:
+            import pynvml
             pynvml.nvmlInit()
             self._thread = threading.Thread(target=self._monitor_gpu, daemon=True)
             self._thread.start()
@@ -31,6 +31,7 @@ class GPUMonitor:
             self._stop_event.set()
             self._thread.join(timeout=1)
             try:
+                import pynvml
                 pynvml.nvmlShutdown()
             except:
                 pass
@@ -39,6 +40,7 @@ class GPUMonitor:
     def _monitor_gpu(self):
         """Continuously monitor GPU utilization and update metrics."""
         try:
+            import pynvml
             device_count = pynvml.nvmlDeviceGetCount()
             while not self._stop_event.is_set():
                 for i in range(device_count):
@@ -0,0 +1,373 @@
+from collections import OrderedDict
+from app.metrics import (
+    KV_CACHE_BLOCKS_TOTAL,
+    KV_CACHE_BLOCKS_USED,
+    KV_CACHE_BLOCKS_SHARED,
+)
+
+
+class OutOfBlocksError(RuntimeError):
+    """Raised when the KV cache has no free block left."""
+
+
+class BlockAllocator:
+    """
+    Free-list allocator for fixed-size KV cache blocks with reference counts.
+
+    Blocks whose reference count drops to zero go back on the free list. A
+    block that still holds a registered prefix keeps its hash until it is
+    handed out again, so a later request with the same prefix can revive it.
+    Such cached blocks are reused last.
+    """
+
+    def __init__(self, num_blocks):
+        """
+        Initialize the allocator.
+
+        Args:
+            num_blocks (int): Number of blocks in the pool
+        """
+        self.num_blocks = num_blocks
+        self.ref_counts = [0] * num_blocks
+        # Blocks referenced by more than one table, kept up to date for metrics
+        self.num_shared = 0
+        self._free = OrderedDict((block, None) for block in range(num_blocks))
+        self._block_to_hash = {}
+        self._hash_to_block = {}
+
+    @property
+    def num_free(self):
+        return len(self._free)
+
+    def allocate(self):
+        """Take a block from the free list, evicting any prefix it still held."""
+        if not self._free:
+            raise OutOfBlocksError("Out of KV cache blocks")
+        block, _ = self._free.popitem(last=False)
+        prefix_hash = self._block_to_hash.pop(block, None)
+        if prefix_hash is not None:
+            del self._hash_to_block[prefix_hash]
+        self.ref_counts[block] = 1
+        return block
+
+    def incref(self, block):
+        """Add a reference to a block, reviving it if it was free."""
+        if self.ref_counts[block] == 0:
+            del self._free[block]
+        elif self.ref_counts[block] == 1:
+            self.num_shared += 1
+        self.ref_counts[block] += 1
+
+    def free(self, block):
+        """Drop a reference to a block, returning it to the free list at zero."""
+        if self.ref_counts[block] <= 0:
+            raise ValueError(f"Block {block} is not allocated")
+        if self.ref_counts[block] == 2:
+            self.num_shared -= 1
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self._free[block] = None
+            if block not in self._block_to_hash:
+                # Plain blocks are reused before blocks that still cache a prefix
+                self._free.move_to_end(block, last=False)
+
+    def register(self, block, prefix_hash):
+        """Make a full block discoverable by the hash of its prefix."""
+        if prefix_hash in self._hash_to_block or block in self._block_to_hash:
+            return
+        self._block_to_hash[block] = prefix_hash
+        self._hash_to_block[prefix_hash] = block
+
+    def lookup(self, prefix_hash):
+        """Return the block caching the given prefix, or None."""
+        return self._hash_to_block.get(prefix_hash)
+
+
+class BlockTable:
+    """Maps the logical token positions of one sequence to physical blocks."""
+
+    def __init__(self):
+        self.blocks = []
+        self.token_ids = []
+        self.prefix_hashes = []
+
+    @property
+    def num_tokens(self):
+        return len(self.token_ids)
+
+
+class BlockManager:
+    """
+    Block bookkeeping for a paged KV cache, independent of tensor storage.
+
+    Full blocks are identified by a hash chained over all tokens up to and
+    including the block, so two sequences only share a block when their
+    whole prefix matches. Shared blocks are copied before they are written
+    to (copy-on-write).
+    """
+
+    def __init__(self, num_blocks, block_size=16):
+        """
+        Initialize the block manager.
+
+        Args:
+            num_blocks (int): Number of blocks in the pool
+            block_size (int): Number of tokens per block
+        """
+        self.block_size = block_size
+        self.allocator = BlockAllocator(num_blocks)
+        KV_CACHE_BLOCKS_TOTAL.set(num_blocks)
+        self._update_metrics()
+
+    def blocks_needed(self, num_tokens):
+        return -(-num_tokens // self.block_size)
+
+    def can_allocate(self, num_tokens):
+        """Whether `num_tokens` more tokens fit in newly allocated blocks."""
+        return self.blocks_needed(num_tokens) <= self.allocator.num_free
+
+    def match_prefix(self, table, token_ids):
+        """
+        Attach cached blocks holding a prefix of `token_ids` to an empty table.
+
+        At least one token is always left unmatched so the caller still runs
+        the model on the last prompt position to get its logits.
+
+        Returns:
+            int: Number of prompt tokens covered by shared blocks
+        """
+        if table.blocks:
+            raise ValueError("Prefix matching requires an empty block table")
+        prefix_hash = None
+        max_blocks = (len(token_ids) - 1) // self.block_size
+        for i in range(max_blocks):
+            block_tokens = token_ids[i * self.block_size:(i + 1) * self.block_size]
+            prefix_hash = hash((prefix_hash, tuple(block_tokens)))
+            block = self.allocator.lookup(prefix_hash)
+            if block is None:
+                break
+            self.allocator.incref(block)
+            table.blocks.append(block)
+            table.token_ids.extend(block_tokens)
+            table.prefix_hashes.append(prefix_hash)
+
+        self._update_metrics()
+        return table.num_tokens
+
+    def reserve(self, table, num_new_tokens):
+        """
+        Make room for `num_new_tokens` more tokens in a table.
+
+        Returns:
+            list[tuple[int, int]]: (src, dst) block copies the storage must
+                perform before writing, for shared blocks that were split off
+        """
+        copies = []
+        offset = table.num_tokens % self.block_size
+        if offset and num_new_tokens:
+            last = table.blocks[-1]
+            if self.allocator.ref_counts[last] > 1:
+                new_block = self.allocator.allocate()
+                self.allocator.free(last)
+                table.blocks[-1] = new_block
+                copies.append((last, new_block))
+
+        needed = self.blocks_needed(table.num_tokens + num_new_tokens) - len(table.blocks)
+        if needed > self.allocator.num_free:
+            self._update_metrics()
+            raise OutOfBlocksError(
+                f"Need {needed} KV cache blocks, only {self.allocator.num_free} free"
+            )
+        for _ in range(needed):
+            table.blocks.append(self.allocator.allocate())
+        self._update_metrics()
+        return copies
+
+    def append_tokens(self, table, token_ids):
+        """Record tokens written to reserved slots and register full blocks."""
+        table.token_ids.extend(token_ids)
+        num_full = table.num_tokens // self.block_size
+        while len(table.prefix_hashes) < num_full:
+            i = len(table.prefix_hashes)
+            parent = table.prefix_hashes[-1] if table.prefix_hashes else None
+            block_tokens = table.token_ids[i * self.block_size:(i + 1) * self.block_size]
+            prefix_hash = hash((parent, tuple(block_tokens)))
+            table.prefix_hashes.append(prefix_hash)
+            self.allocator.register(table.blocks[i], prefix_hash)
+
+    def fork(self, table):
+        """Return a new table sharing every block of `table`."""
+        child = BlockTable()
+        for block in table.blocks:
+            self.allocator.incref(block)
+        child.blocks = list(table.blocks)
+        child.token_ids = list(table.token_ids)
+        child.prefix_hashes = list(table.prefix_hashes)
+        self._update_metrics()
+        return child
+
+    def free(self, table):
+        """Release every block of a table and reset it."""
+        # Last block first, so a cached prefix is evicted from its end and the
+        # blocks left behind still match from the start
+        for block in reversed(table.blocks):
+            self.allocator.free(block)
+        table.blocks = []
+        table.token_ids = []
+        table.prefix_hashes = []
+        self._update_metrics()
+
+    def occupancy(self):
+        """
+        Summarize how the pool is used.
+
+        Returns:
+            dict: Total, used, free and shared block counts
+        """
+        return {
+            "total_blocks": self.allocator.num_blocks,
+            "used_blocks": self.allocator.num_blocks - self.allocator.num_free,
+            "free_blocks": self.allocator.num_free,
+            "shared_blocks": self.allocator.num_shared,
+        }
+
+    def _update_metrics(self):
+        KV_CACHE_BLOCKS_USED.set(self.allocator.num_blocks - self.allocator.num_free)
+        KV_CACHE_BLOCKS_SHARED.set(self.allocator.num_shared)
+
+
+def kv_cache_geometry(config):
+    """
+    Read the per-token KV layout from a Hugging Face model config.
+
+    Returns:
+        tuple[int, int, int]: (num_layers, num_kv_heads, head_dim)
+    """
+    num_layers = config.num_hidden_layers
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    return num_layers, num_kv_heads, head_dim
+
+
+class PagedKVCache:
+    """
+    Preallocated block pool holding keys and values for every layer.
+
+    The model attends over the pool directly (see app.paged_attention): new
+    keys and values are written into the slots reserved for them and every
+    layer reads its keys and values back by slot index. Reading by index still
+    copies one layer's keys and values for the sequences in a forward pass, so
+    a step costs O(seq_len) copying per layer, but that copy is freed before
+    the next layer runs. `from_model` keeps room for it out of the pool.
+    """
+
+    def __init__(self, num_blocks, block_size, num_layers, num_kv_heads, head_dim,
+                 dtype=None, device="cpu"):
+        """
+        Initialize the cache and allocate its block pool.
+
+        Args:
+            num_blocks (int): Number of blocks in the pool
+            block_size (int): Number of tokens per block
+            num_layers (int): Number of transformer layers
+            num_kv_heads (int): Number of key/value heads per layer
+            head_dim (int): Size of each attention head
+            dtype (torch.dtype): Cache dtype, defaults to float32
+            device (str): Device the pool is allocated on
+        """
+        import torch
+
+        self.block_size = block_size
+        self.num_layers = num_layers
+        self.blocks = BlockManager(num_blocks, block_size)
+        shape = (num_layers, num_blocks, block_size, num_kv_heads, head_dim)
+        self.key_cache = torch.zeros(shape, dtype=dtype or torch.float32, device=device)
+        self.value_cache = torch.zeros_like(self.key_cache)
+        # Views with one row per token slot, slot = block * block_size + offset
+        slots_shape = (num_layers, num_blocks * block_size, num_kv_heads, head_dim)
+        self.key_slots = self.key_cache.view(slots_shape)
+        self.value_slots = self.value_cache.view(slots_shape)
+
+    @staticmethod
+    def bytes_per_block(block_size, num_layers, num_kv_heads, head_dim, dtype_size):
+        """Memory taken by one block of keys and values."""
+        return 2 * num_layers * num_kv_heads * block_size * head_dim * dtype_size
+
+    @classmethod
+    def workspace_bytes(cls, num_tokens, num_kv_heads, head_dim, dtype_size):
+        """Transient memory for one layer's keys and values of `num_tokens` read by slot."""
+        return cls.bytes_per_block(num_tokens, 1, num_kv_heads, head_dim, dtype_size)
+
+    @classmethod
+    def from_model(cls, model, memory_bytes, block_size=16, device="cpu", max_seq_len=None,
+                   max_num_seqs=1):
+        """
+        Size a cache to a memory budget using the model's config and dtype.
+
+        Args:
+            model: Hugging Face causal LM
+            memory_bytes (int): Memory budget for keys and values, including
+                the workspace one layer reads into during a forward pass
+            block_size (int): Number of tokens per block
+            device (str): Device the pool is allocated on
+            max_seq_len (int): Longest sequence the workspace is sized for,
+                defaults to the model's maximum position
+            max_num_seqs (int): Sequences decoded together in one forward pass
+        """
+        dtype = next(model.parameters()).dtype
+        num_layers, num_kv_heads, head_dim = kv_cache_geometry(model.config)
+        dtype_size = next(model.parameters()).element_size()
+        max_seq_len = max_seq_len or model.config.max_position_embeddings
+        per_block = cls.bytes_per_block(block_size, num_layers, num_kv_heads, head_dim, dtype_size)
+        workspace = cls.workspace_bytes(max_seq_len * max_num_seqs, num_kv_heads, head_dim, dtype_size)
+        num_blocks = (memory_bytes - workspace) // per_block
+        if num_blocks < 1:
+            raise ValueError(
+                f"KV cache budget of {memory_bytes} bytes does not cover the {workspace} byte "
+                f"workspace for {max_num_seqs} sequences of {max_seq_len} tokens"
+            )
+        return cls(num_blocks, block_size, num_layers, num_kv_heads, head_dim,
+                   dtype=dtype, device=device)
+
+    def reserve(self, table, num_new_tokens):
+        """Make room for new tokens, copying shared blocks that get written."""
+        for src, dst in self.blocks.reserve(table, num_new_tokens):
+            self.key_cache[:, dst].copy_(self.key_cache[:, src])
+            self.value_cache[:, dst].copy_(self.value_cache[:, src])
+
+    def slot_ids(self, table, start, end):
+        """Return the pool slots of positions [start, end) of a table as a tensor."""
+        import torch
+
+        device = self.key_cache.device
+        first, last = start // self.block_size, -(-end // self.block_size)
+        blocks = torch.tensor(table.blocks[first:last], dtype=torch.long, device=device)
+        slots = (blocks[:, None] * self.block_size + torch.arange(self.block_size, device=device)).view(-1)
+        offset = start - first * self.block_size
+        return slots[offset:offset + end - start]
+
+    def write_tensors(self, table, keys, values, token_ids):
+        """
+        Append keys and values of shape (layers, kv_heads, tokens, head_dim) to a table.
+
+        Slots for `token_ids` must already be reserved.
+        """
+        slots = self.slot_ids(table, table.num_tokens, table.num_tokens + len(token_ids))
+        device = self.key_cache.device
+        self.key_slots[:, slots] = keys.permute(0, 2, 1, 3).to(device, self.key_cache.dtype)
+        self.value_slots[:, slots] = values.permute(0, 2, 1, 3).to(device, self.value_cache.dtype)
+        self.blocks.append_tokens(table, token_ids)
+
+    def read(self, table, start, end):
+        """
+        Gather the keys and values of positions [start, end) of a table.
+
+        Returns:
+            tuple: Keys and values of shape (layers, kv_heads, end - start, head_dim)
+        """
+        slots = self.slot_ids(table, start, end)
+        return self.key_slots[:, slots].permute(0, 2, 1, 3), self.value_slots[:, slots].permute(0, 2, 1, 3)
+
+    def free(self, table):
+        self.blocks.free(table)
@@ -1,31 +1,104 @@
 from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
 from prometheus_client import start_http_server
-import uvicorn
 import time
 import threading
 import os
 
 from app.metrics import MetricsMiddleware, REQUEST_LATENCY
 from app.model import LLMModel
+from app.placement import Dispatcher
+from app.prefix_store import PrefixStore
 from app.gpu_monitor import GPUMonitor
 
-# Initialize the model
-llm = LLMModel()
+# Initialize the model; torch and transformers are only imported once a model is loaded
+PREFILL_CHUNK_SIZE = int(os.environ.get("PREFILL_CHUNK_SIZE", 512))
+# The paged KV cache is opt-in, it preallocates its whole budget on every replica
+KV_CACHE_MEMORY_MB = int(os.environ.get("KV_CACHE_MEMORY_MB", 0))
+# Only the paged KV cache batches decode steps, without it a few sequences suffice to overlap prefill
+MAX_NUM_SEQS = int(os.environ.get("MAX_NUM_SEQS", 8 if KV_CACHE_MEMORY_MB else 2))
+KV_CACHE_BLOCK_SIZE = int(os.environ.get("KV_CACHE_BLOCK_SIZE", 16))
+
+# Disk cache of tokenized prompts and prefix KV snapshots, disabled unless a directory is set
+PREFIX_STORE_DIR = os.environ.get("PREFIX_STORE_DIR")
+PREFIX_STORE_MAX_GB = float(os.environ.get("PREFIX_STORE_MAX_GB", 20))
+PREFIX_STORE_SEGMENT_SIZE = int(os.environ.get("PREFIX_STORE_SEGMENT_SIZE", 256))
+PREFIX_STORE_PRELOAD = int(os.environ.get("PREFIX_STORE_PRELOAD", 32))
+prefix_store = None  # Opened during startup
+
+def create_llm():
+    """Create an unloaded model for one replica."""
+    return LLMModel(
+        prefill_chunk_size=PREFILL_CHUNK_SIZE,
+        max_num_seqs=MAX_NUM_SEQS,
+        kv_cache_memory_mb=KV_CACHE_MEMORY_MB,
+        kv_cache_block_size=KV_CACHE_BLOCK_SIZE,
+        prefix_store=prefix_store,
+        preload_prefixes=PREFIX_STORE_PRELOAD
+    )
+
+# "replica" loads one model copy per GPU, "pipeline" splits each copy over PIPELINE_SIZE GPUs
+PLACEMENT_MODE = os.environ.get("PLACEMENT_MODE", "replica")
+PIPELINE_SIZE = int(os.environ.get("PIPELINE_SIZE", 0)) or None
+dispatcher = Dispatcher(create_llm, mode=PLACEMENT_MODE, pipeline_size=PIPELINE_SIZE)
 
-# Start Prometheus metrics server on a separate port
 METRICS_PORT = int(os.environ.get("METRICS_PORT", 8000))
-threading.Thread(target=start_http_server, args=(METRICS_PORT,), daemon=True).start()
-print(f"Prometheus metrics server started on port {METRICS_PORT}")
 
-# Initialize GPU monitoring
+# Optional model to load in the background at startup
+MODEL_NAME_OR_PATH = os.environ.get("MODEL_NAME_OR_PATH")
+
 gpu_monitor = GPUMonitor(interval=10)  # Check GPU every 10 seconds
-gpu_monitor.start()
+
+# Readiness state, reported by /ready
+startup_state = {"started": False, "loading": False, "error": None}
+
+def _load_startup_model(model_name_or_path):
+    """Load the startup model, recording failures for /ready."""
+    startup_state["loading"] = True
+    try:
+        dispatcher.load_model(model_name_or_path)
+    except Exception as e:
+        startup_state["error"] = str(e)
+        print(f"Could not load startup model {model_name_or_path}: {e}")
+    finally:
+        startup_state["loading"] = False
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start side effects on startup and clean them up on shutdown."""
+    global prefix_store
+    
+    # Start Prometheus metrics server on a separate port
+    threading.Thread(target=start_http_server, args=(METRICS_PORT,), daemon=True).start()
+    print(f"Prometheus metrics server started on port {METRICS_PORT}")
+    
+    gpu_monitor.start()
+    
+    if PREFIX_STORE_DIR:
+        prefix_store = PrefixStore(
+            PREFIX_STORE_DIR,
+            int(PREFIX_STORE_MAX_GB * 1024 ** 3),
+            segment_size=PREFIX_STORE_SEGMENT_SIZE
+        )
+    
+    # Load in the background so /health answers while weights are loading
+    if MODEL_NAME_OR_PATH:
+        threading.Thread(target=_load_startup_model, args=(MODEL_NAME_OR_PATH,), daemon=True).start()
+    
+    startup_state["started"] = True
+    yield
+    
+    gpu_monitor.stop()
+    dispatcher.stop()
+    if prefix_store is not None:
+        prefix_store.flush()
 
 # FastAPI app
-app = FastAPI(title="LLM API Service")
+app = FastAPI(title="LLM API Service", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -55,10 +128,12 @@ class ModelLoadRequest(BaseModel):
 async def generate_text(request: TextGenerationRequest):
     """Generate text based on the prompt."""
     try:
-        if llm.model is None:
+        if not dispatcher.is_loaded:
             raise HTTPException(status_code=400, detail="Model not loaded. Call /load endpoint first.")
         
-        response = llm.generate(
+        # Run in a worker thread so concurrent requests reach the scheduler together
+        response = await run_in_threadpool(
+            dispatcher.generate,
             prompt=request.prompt,
             max_length=request.max_length,
             temperature=request.temperature,
@@ -73,22 +148,33 @@ async def generate_text(request: TextGenerationRequest):
 async def load_model(request: ModelLoadRequest):
     """Load a model by name or path."""
     try:
-        llm.load_model(request.model_name_or_path)
+        # Loading blocks for a long time, keep the event loop free for /health
+        await run_in_threadpool(dispatcher.load_model, request.model_name_or_path)
         return {"status": "success", "model": request.model_name_or_path}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint."""
-    return {"status": "healthy", "model_loaded": llm.model is not None}
+    """Liveness check, healthy as long as the process serves requests."""
+    return {"status": "healthy", "model_loaded": dispatcher.is_loaded}
 
-@app.on_event("shutdown")
-def shutdown_event():
-    """Clean up resources when shutting down."""
-    gpu_monitor.stop()
+@app.get("/ready")
+async def ready_check():
+    """Readiness check, ready once startup finished and a model is loaded."""
+    ready = startup_state["started"] and dispatcher.is_loaded
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "model_loaded": dispatcher.is_loaded,
+        "replicas": [replica.name for replica in dispatcher.replicas],
+        "loading": startup_state["loading"],
+        "error": startup_state["error"],
+    }
+    return JSONResponse(status_code=200 if ready else 503, content=body)
 
 if __name__ == "__main__":
+    import uvicorn
+    
     # Get host and port from environment variables with defaults
     host = os.environ.get("HOST", "0.0.0.0")
     port = int(os.environ.get("PORT", 8080))
@@ -21,6 +21,95 @@ TOKENS_GENERATED = Counter(
     'Total number of tokens generated'
 )
 
+# Chunked prefill scheduling metrics
+TIME_TO_FIRST_TOKEN = Histogram(
+    'llm_time_to_first_token_seconds',
+    'Time from request arrival to the first generated token',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+INTER_TOKEN_LATENCY = Histogram(
+    'llm_inter_token_latency_seconds',
+    'Time between consecutive generated tokens of a sequence',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+
+PREFILL_CHUNKS = Counter(
+    'llm_prefill_chunks_total',
+    'Total number of prompt prefill chunks executed'
+)
+
+PREFILL_CHUNK_SIZE = Gauge(
+    'llm_prefill_chunk_size_tokens',
+    'Configured prompt token budget per scheduler step (0 = unchunked)'
+)
+
+RUNNING_SEQUENCES = Gauge(
+    'llm_running_sequences',
+    'Number of sequences currently being prefilled or decoded'
+)
+
+# Paged KV cache metrics
+KV_CACHE_BLOCKS_TOTAL = Gauge(
+    'llm_kv_cache_blocks_total',
+    'Number of blocks in the paged KV cache pool'
+)
+
+KV_CACHE_BLOCKS_USED = Gauge(
+    'llm_kv_cache_blocks_used',
+    'Number of KV cache blocks referenced by at least one sequence'
+)
+
+KV_CACHE_BLOCKS_SHARED = Gauge(
+    'llm_kv_cache_blocks_shared',
+    'Number of KV cache blocks shared by more than one sequence'
+)
+
+KV_CACHE_PREFIX_HIT_TOKENS = Counter(
+    'llm_kv_cache_prefix_hit_tokens_total',
+    'Prompt tokens served from shared prefix blocks instead of prefill'
+)
+
+KV_CACHE_PREEMPTIONS = Counter(
+    'llm_kv_cache_preemptions_total',
+    'Sequences preempted because the KV cache ran out of blocks'
+)
+
+# Placement metrics
+REPLICA_LOAD = Gauge(
+    'llm_replica_load_tokens',
+    'Outstanding prefill and decode tokens queued on a model replica',
+    ['device']  # Devices the replica is placed on
+)
+
+REPLICA_REQUESTS = Counter(
+    'llm_replica_requests_total',
+    'Requests dispatched to a model replica',
+    ['device']
+)
+
+# Persistent prefix store metrics
+PREFIX_STORE_BYTES = Gauge(
+    'llm_prefix_store_bytes',
+    'Size of the on-disk prefix store'
+)
+
+PREFIX_STORE_HITS = Counter(
+    'llm_prefix_store_hits_total',
+    'Entries read from the on-disk prefix store',
+    ['kind']  # 'tokens' or 'kv'
+)
+
+PREFIX_STORE_EVICTIONS = Counter(
+    'llm_prefix_store_evictions_total',
+    'Entries evicted from the on-disk prefix store to stay within its size limit'
+)
+
+PREFIX_STORE_DROPPED_WRITES = Counter(
+    'llm_prefix_store_dropped_writes_total',
+    'Prefix KV snapshots dropped because too many bytes were already waiting to be written'
+)
+
 # GPU utilization metric
 GPU_UTILIZATION = Gauge(
     'nvidia_gpu_utilization',
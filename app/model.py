@@ -1,21 +1,102 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
 from app.metrics import TOKENS_GENERATED
+import hashlib
 import os
 
+# Local model files up to this size are fingerprinted by content, larger ones by size and mtime
+FINGERPRINT_CONTENT_LIMIT = 64 * 1024 * 1024
+
+def model_fingerprint(model_name_or_path, config):
+    """
+    Identify the exact weights and tokenizer behind a model name or path.
+    
+    Hub models are identified by the commit they were downloaded from. Local
+    directories are identified by the content of their config and tokenizer
+    files and the size and modification time of their weight files.
+    
+    Args:
+        model_name_or_path (str): Model ID on Hugging Face or local path
+        config: Hugging Face config of the loaded model
+        
+    Returns:
+        str: Short hex digest that changes whenever the files do
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(model_name_or_path):
+        for entry in sorted(os.scandir(model_name_or_path), key=lambda e: e.name):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            digest.update(entry.name.encode())
+            if stat.st_size <= FINGERPRINT_CONTENT_LIMIT:
+                with open(entry.path, "rb") as f:
+                    digest.update(f.read())
+            else:
+                digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    elif getattr(config, "_commit_hash", None):
+        digest.update(config._commit_hash.encode())
+    else:
+        # No commit recorded, fall back to the config itself
+        digest.update(config.to_json_string().encode())
+    return digest.hexdigest()[:16]
+
 class LLMModel:
-    def __init__(self):
+    def __init__(self, prefill_chunk_size=512, max_num_seqs=8, kv_cache_memory_mb=0,
+                 kv_cache_block_size=16, prefix_store=None, preload_prefixes=0):
+        """
+        Initialize the model wrapper.
+        
+        Args:
+            prefill_chunk_size (int): Prompt tokens prefilled per scheduler step,
+                0 disables chunking
+            max_num_seqs (int): Maximum number of sequences generated concurrently
+            kv_cache_memory_mb (int): Memory reserved for the paged KV cache and
+                the workspace attention reads it into, 0 keeps Hugging Face's per-sequence dynamic cache
+            kv_cache_block_size (int): Tokens per paged KV cache block
+            prefix_store (PrefixStore): Disk store for tokenized prompts and
+                prefix KV snapshots
+            preload_prefixes (int): Number of most used stored prefix segments
+                restored into the paged KV cache when a model is loaded
+        """
         self.model = None
         self.tokenizer = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.scheduler = None
+        self.kv_cache = None
+        self.prefill_chunk_size = prefill_chunk_size
+        self.max_num_seqs = max_num_seqs
+        self.kv_cache_memory_mb = kv_cache_memory_mb
+        self.kv_cache_block_size = kv_cache_block_size
+        self.prefix_store = prefix_store
+        self.preload_prefixes = preload_prefixes
+        self.model_key = None
+        self.device = None
     
-    def load_model(self, model_name_or_path="microsoft/phi-2"):
+    def load_model(self, model_name_or_path="microsoft/phi-2", device_ids=None, max_memory=None):
         """
         Load the model and tokenizer.
         
         Args:
             model_name_or_path (str): Model ID on Hugging Face or local path
+            device_ids (list[int]): CUDA devices to place the model on. One device
+                holds a full copy, several split the layers evenly between them.
+                None lets accelerate spread the model over every visible GPU.
+            max_memory (dict): Per-device memory limits used when splitting
         """
+        # Imported here so starting the service does not pay for torch/transformers
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        from app.scheduler import ChunkedPrefillScheduler
+        from app.kv_cache import PagedKVCache
+        
+        if device_ids:
+            self.device = f"cuda:{device_ids[0]}"
+            if len(device_ids) == 1:
+                device_map = {"": device_ids[0]}
+            else:
+                device_map = "balanced"
+        else:
+            if self.device is None:
+                self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            device_map = "auto" if self.device == "cuda" else None
         print(f"Loading model {model_name_or_path} on {self.device}")
         
         # If model_name_or_path is a directory, check if it exists
@@ -30,18 +111,122 @@ class LLMModel:
         
         self.model = AutoModelForCausalLM.from_pretrained(
             model_name_or_path,
-            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-            device_map="auto" if self.device == "cuda" else None,
+            torch_dtype=torch.float16 if self.device.startswith("cuda") else torch.float32,
+            device_map=device_map,
+            max_memory=max_memory if device_map == "balanced" else None,
             trust_remote_code=True
         )
         
+        self.model.eval()
+        # Stored token IDs and KV snapshots are only valid for these exact files
+        fingerprint = model_fingerprint(model_name_or_path, self.model.config)
+        self.model_key = f"{model_name_or_path}:{self.model.dtype}:{fingerprint}"
+        
+        # Sequences queued against the previous model cannot be continued
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        
+        # Drop the previous pool before allocating one for the new model
+        self.kv_cache = None
+        if self.kv_cache_memory_mb:
+            if self.prefix_store is not None and self.prefix_store.segment_size % self.kv_cache_block_size:
+                raise ValueError("Prefix store segment size must be a multiple of the KV cache block size")
+            if self.device.startswith("cuda"):
+                # Return the previous pool to the driver so it counts as free
+                torch.cuda.empty_cache()
+                free_bytes, _ = torch.cuda.mem_get_info(self.device)
+                if self.kv_cache_memory_mb * 1024 * 1024 > free_bytes:
+                    raise ValueError(
+                        f"KV cache of {self.kv_cache_memory_mb} MB does not fit in the "
+                        f"{free_bytes // (1024 * 1024)} MB left on {self.device}"
+                    )
+            self.kv_cache = PagedKVCache.from_model(
+                self.model,
+                self.kv_cache_memory_mb * 1024 * 1024,
+                block_size=self.kv_cache_block_size,
+                device=self.device,
+                max_num_seqs=self.max_num_seqs
+            )
+            print(f"Paged KV cache: {self.kv_cache.blocks.allocator.num_blocks} blocks of {self.kv_cache_block_size} tokens")
+        
+        self.scheduler = ChunkedPrefillScheduler(
+            self.model,
+            self.device,
+            prefill_chunk_size=self.prefill_chunk_size,
+            max_num_seqs=self.max_num_seqs,
+            kv_cache=self.kv_cache,
+            prefix_store=self.prefix_store,
+            model_key=self.model_key
+        )
+        
+        # Warm the cache with shared prefixes from previous runs before taking requests
+        if self.preload_prefixes:
+            restored = self.scheduler.preload_prefixes(self.preload_prefixes)
+            if restored:
+                print(f"Preloaded {restored} prefix tokens from the prefix store")
+        self.scheduler.start()
+        
         print(f"Model loaded successfully")
         return self
     
+    def load(self):
+        """Outstanding work queued on this model's scheduler, in tokens."""
+        if self.scheduler is None:
+            return 0
+        return self.scheduler.load()
+    
+    def submit(self, prompt, max_length=100, temperature=0.7, top_p=0.9):
+        """
+        Tokenize the prompt and queue it on the scheduler without waiting.
+        
+        Returns:
+            Sequence: Handle to pass to `wait`
+        """
+        return self.enqueue(self.prepare(prompt, max_length, temperature, top_p))
+    
+    def prepare(self, prompt, max_length=100, temperature=0.7, top_p=0.9):
+        """
+        Tokenize the prompt into a sequence ready for `enqueue`.
+        
+        Returns:
+            Sequence: Unqueued sequence
+        """
+        if self.model is None or self.tokenizer is None:
+            raise ValueError("Model and tokenizer must be loaded before generation")
+        
+        from app.scheduler import Sequence
+        
+        # Encode the prompt, reusing token IDs of long prompts seen before
+        input_ids = None
+        if self.prefix_store is not None:
+            input_ids = self.prefix_store.get_tokens(self.model_key, prompt)
+        if input_ids is None:
+            input_ids = self.tokenizer(prompt).input_ids
+            if self.prefix_store is not None:
+                self.prefix_store.put_tokens(self.model_key, prompt, input_ids)
+        
+        return Sequence(
+            input_ids,
+            max_new_tokens=max_length,
+            temperature=temperature,
+            top_p=top_p,
+            eos_token_id=self.tokenizer.eos_token_id
+        )
+    
+    def enqueue(self, seq):
+        """Queue a prepared sequence on the scheduler without waiting."""
+        if self.scheduler is None:
+            raise ValueError("Model must be loaded before generation")
+        return self.scheduler.submit(seq)
+    
     def generate(self, prompt, max_length=100, temperature=0.7, top_p=0.9):
         """
         Generate text based on the prompt.
         
+        The prompt is handed to the scheduler, which prefills it in chunks
+        interleaved with decode steps of other in-flight requests. This call
+        blocks until the sequence finished.
+        
         Args:
             prompt (str): The input prompt
             max_length (int): Maximum length of generated tokens
@@ -51,28 +236,23 @@ class LLMModel:
         Returns:
             str: Generated text
         """
-        if self.model is None or self.tokenizer is None:
-            raise ValueError("Model and tokenizer must be loaded before generation")
+        return self.wait(self.submit(prompt, max_length, temperature, top_p))
+    
+    def wait(self, seq):
+        """
+        Block until a submitted sequence finished and decode it.
         
-        # Encode the prompt
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        input_ids_length = len(inputs.input_ids[0])
-        
-        # Generate
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_length=input_ids_length + max_length,
-                temperature=temperature,
-                top_p=top_p,
-                do_sample=True
-            )
+        Returns:
+            str: Generated text
+        """
+        seq.done.wait()
+        if seq.error is not None:
+            raise seq.error
         
-        # Decode the generated text
-        generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        # Decode the prompt together with the generated tokens
+        generated_text = self.tokenizer.decode(seq.input_ids + seq.output_ids, skip_special_tokens=True)
         
         # Update metrics - count tokens generated
-        tokens_generated = len(outputs[0]) - input_ids_length
-        TOKENS_GENERATED.inc(tokens_generated)
+        TOKENS_GENERATED.inc(len(seq.output_ids))
         
         return generated_text
\ No newline at end of file
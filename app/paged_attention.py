@@ -0,0 +1,187 @@
+import torch
+
+try:
+    from transformers.cache_utils import Cache
+except ImportError:
+    # transformers < 4.36 only knows tuple caches
+    Cache = None
+try:
+    from transformers.cache_utils import CacheLayerMixin
+except ImportError:
+    CacheLayerMixin = None
+
+
+class PagedBatch:
+    """
+    Slot indexes for one forward pass over a batch of block tables.
+
+    Every sequence contributes the same number of new tokens. Their keys and
+    values are written straight into the pool slots reserved for them, and
+    each layer then reads its keys and values back by slot index. Shorter
+    sequences are left-padded to the longest one and the padding is masked.
+    """
+
+    def __init__(self, kv_cache, tables, num_new_tokens):
+        """
+        Initialize the batch.
+
+        Args:
+            kv_cache (PagedKVCache): Pool the tables' blocks live in
+            tables (list[BlockTable]): Tables with slots reserved for the new tokens
+            num_new_tokens (int): New tokens per sequence
+        """
+        self.kv_cache = kv_cache
+        device = kv_cache.key_cache.device
+        lengths = [table.num_tokens + num_new_tokens for table in tables]
+        self.kv_length = max(lengths)
+        self.past_length = self.kv_length - num_new_tokens
+        self.num_updated_layers = 0
+
+        self.write_slots = torch.cat([
+            kv_cache.slot_ids(table, table.num_tokens, table.num_tokens + num_new_tokens)
+            for table in tables
+        ])
+        # Padding reads slot 0, whatever it holds is hidden by the attention mask
+        read_slots = torch.zeros(len(tables), self.kv_length, dtype=torch.long, device=device)
+        self.attention_mask = torch.zeros(len(tables), self.kv_length, dtype=torch.long)
+        for row, (table, length) in enumerate(zip(tables, lengths)):
+            read_slots[row, self.kv_length - length:] = kv_cache.slot_ids(table, 0, length)
+            self.attention_mask[row, self.kv_length - length:] = 1
+        self.read_slots = read_slots.view(-1)
+
+    def update(self, key_states, value_states, layer_idx):
+        """
+        Store a layer's new keys and values and return all of the batch's.
+
+        Args:
+            key_states (torch.Tensor): New keys of shape (batch, kv_heads, new_tokens, head_dim)
+            value_states (torch.Tensor): New values, same layout
+
+        Returns:
+            tuple: Keys and values of shape (batch, kv_heads, kv_length, head_dim)
+                on the device and in the dtype of `key_states`
+        """
+        batch, num_heads, _, head_dim = key_states.shape
+        outputs = []
+        for slots, states in (
+            (self.kv_cache.key_slots[layer_idx], key_states),
+            (self.kv_cache.value_slots[layer_idx], value_states),
+        ):
+            new = states.transpose(1, 2).reshape(-1, num_heads, head_dim)
+            slots[self.write_slots] = new.to(slots.device, slots.dtype)
+            gathered = slots[self.read_slots].view(batch, self.kv_length, num_heads, head_dim)
+            # Layers of a pipeline-split model run on their own device
+            outputs.append(gathered.transpose(1, 2).to(states.device, states.dtype))
+        self.num_updated_layers += 1
+        return outputs[0], outputs[1]
+
+
+if CacheLayerMixin is not None:
+    class _PagedLayer(CacheLayerMixin):
+        """One layer of a paged batch, for transformers versions with per-layer caches."""
+
+        is_sliding = False
+
+        def __init__(self, batch, layer_idx):
+            super().__init__()
+            self.batch = batch
+            self.layer_idx = layer_idx
+            self.is_initialized = True
+
+        def lazy_initialization(self, key_states, value_states):
+            pass
+
+        def update(self, key_states, value_states, *args, **kwargs):
+            return self.batch.update(key_states, value_states, self.layer_idx)
+
+        def get_mask_sizes(self, query_length):
+            return self.batch.past_length + query_length, 0
+
+        def get_seq_length(self):
+            return self.batch.past_length
+
+        def get_max_length(self):
+            return -1
+
+    def _build_cache(batch, num_layers):
+        return Cache(layers=[_PagedLayer(batch, i) for i in range(num_layers)])
+
+elif Cache is not None:
+    class _PagedCache(Cache):
+        """A paged batch behind the whole-model Cache interface of older transformers."""
+
+        def __init__(self, batch):
+            super().__init__()
+            self.batch = batch
+
+        def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+            return self.batch.update(key_states, value_states, layer_idx)
+
+        def get_seq_length(self, layer_idx=0):
+            return self.batch.past_length
+
+        def get_max_length(self):
+            return None
+
+        def get_max_cache_shape(self):
+            return None
+
+    def _build_cache(batch, num_layers):
+        return _PagedCache(batch)
+
+else:
+    _build_cache = None
+
+
+def paged_forward(model, kv_cache, tables, token_ids, device):
+    """
+    Run the model over new tokens of one or more sequences in the block pool.
+
+    Attention reads every layer's keys and values from the pool by slot, so
+    the only copy is one layer's keys and values for the batch at a time.
+
+    Args:
+        model: Causal LM that reads its cache through `Cache.update`
+        kv_cache (PagedKVCache): Pool holding the sequences' keys and values
+        tables (list[BlockTable]): Tables with slots reserved for the new tokens
+        token_ids (list[list[int]]): New tokens per sequence, all the same length
+        device (str): Device the input tensors are placed on
+
+    Returns:
+        torch.Tensor: Logits of the last new position of each sequence
+    """
+    if _build_cache is None:
+        raise RuntimeError("Paged attention needs a transformers version with Cache support")
+    num_new_tokens = len(token_ids[0])
+    batch = PagedBatch(kv_cache, tables, num_new_tokens)
+    position_ids = [
+        list(range(table.num_tokens, table.num_tokens + num_new_tokens)) for table in tables
+    ]
+    outputs = model(
+        input_ids=torch.tensor(token_ids, dtype=torch.long, device=device),
+        attention_mask=batch.attention_mask.to(device),
+        position_ids=torch.tensor(position_ids, dtype=torch.long, device=device),
+        past_key_values=_build_cache(batch, kv_cache.num_layers),
+        use_cache=True,
+    )
+    if batch.num_updated_layers != kv_cache.num_layers:
+        raise RuntimeError("The model did not read its keys and values from the paged cache")
+    for table, ids in zip(tables, token_ids):
+        kv_cache.blocks.append_tokens(table, ids)
+    return outputs.logits[:, -1, :]
+
+
+def supports_paged_attention(model, kv_cache, device):
+    """Whether the model runs on the paged cache, checked with a one-token forward pass."""
+    from app.kv_cache import BlockTable
+
+    table = BlockTable()
+    try:
+        kv_cache.reserve(table, 1)
+        with torch.no_grad():
+            paged_forward(model, kv_cache, [table], [[0]], device)
+        return True
+    except Exception:
+        return False
+    finally:
+        kv_cache.free(table)
@@ -0,0 +1,238 @@
+import threading
+from app.metrics import REPLICA_LOAD, REPLICA_REQUESTS
+
+PLACEMENT_MODES = ("replica", "pipeline")
+
+
+class DeviceSpec:
+    """A CUDA device models can be placed on."""
+
+    def __init__(self, index, name="", total_memory=0):
+        """
+        Initialize the device description.
+
+        Args:
+            index (int): CUDA device index
+            name (str): Device name
+            total_memory (int): Device memory in bytes
+        """
+        self.index = index
+        self.name = name
+        self.total_memory = total_memory
+
+    def __repr__(self):
+        return f"DeviceSpec(index={self.index}, name={self.name!r}, total_memory={self.total_memory})"
+
+
+class ReplicaPlan:
+    """The devices one copy of the model is placed on."""
+
+    def __init__(self, device_ids, max_memory=None):
+        """
+        Initialize the plan.
+
+        Args:
+            device_ids (list[int]): CUDA devices, empty for CPU
+            max_memory (dict): Per-device memory limits when the layers are split
+        """
+        self.device_ids = list(device_ids)
+        self.max_memory = max_memory
+
+    @property
+    def name(self):
+        if not self.device_ids:
+            return "cpu"
+        return "cuda:" + ",".join(str(i) for i in self.device_ids)
+
+
+def discover_devices():
+    """
+    List the CUDA devices visible to this process.
+
+    Uses torch rather than NVML because placement needs CUDA indices, which
+    follow CUDA_VISIBLE_DEVICES while NVML indices do not.
+
+    Returns:
+        list[DeviceSpec]: Empty on CPU-only hosts
+    """
+    import torch
+
+    if not torch.cuda.is_available():
+        return []
+    devices = []
+    for index in range(torch.cuda.device_count()):
+        props = torch.cuda.get_device_properties(index)
+        devices.append(DeviceSpec(index, props.name, props.total_memory))
+    return devices
+
+
+def plan_placement(devices, mode="replica", pipeline_size=None, weight_memory_fraction=0.9):
+    """
+    Group devices into model replicas.
+
+    In "replica" mode every device holds a full copy of the model with its
+    own request queue. In "pipeline" mode the layers of each copy are split
+    across `pipeline_size` consecutive devices, which is required when the
+    model does not fit on a single device; with fewer devices per copy than
+    available, the resulting pipelines run as data-parallel replicas.
+
+    Args:
+        devices (list[DeviceSpec]): Devices to place on, empty for CPU
+        mode (str): "replica" or "pipeline"
+        pipeline_size (int): Devices per copy in pipeline mode, defaults to all
+        weight_memory_fraction (float): Share of each device the weights of a
+            split model may use, the rest is left for the KV cache
+
+    Returns:
+        list[ReplicaPlan]: One plan per model copy
+    """
+    if mode not in PLACEMENT_MODES:
+        raise ValueError(f"Unknown placement mode {mode!r}, expected one of {PLACEMENT_MODES}")
+    if not devices:
+        return [ReplicaPlan([])]
+
+    if mode == "replica":
+        return [ReplicaPlan([device.index]) for device in devices]
+
+    pipeline_size = pipeline_size or len(devices)
+    if pipeline_size < 1 or len(devices) % pipeline_size:
+        raise ValueError(
+            f"Cannot split {len(devices)} devices into pipelines of {pipeline_size}"
+        )
+    plans = []
+    for start in range(0, len(devices), pipeline_size):
+        group = devices[start:start + pipeline_size]
+        max_memory = {device.index: int(device.total_memory * weight_memory_fraction) for device in group}
+        plans.append(ReplicaPlan([device.index for device in group], max_memory=max_memory))
+    return plans
+
+
+class Replica:
+    """One loaded copy of the model together with its placement."""
+
+    def __init__(self, plan, llm):
+        self.plan = plan
+        self.llm = llm
+
+    @property
+    def name(self):
+        return self.plan.name
+
+    def load(self):
+        return self.llm.load()
+
+
+class Dispatcher:
+    """
+    Places model replicas on devices and routes requests between them.
+
+    Every replica runs its own scheduler, so each device works through its
+    own queue. A request goes to the replica with the least outstanding work
+    in tokens; idle replicas are picked round-robin.
+    """
+
+    def __init__(self, llm_factory, mode="replica", pipeline_size=None):
+        """
+        Initialize the dispatcher.
+
+        Args:
+            llm_factory (callable): Returns a new, unloaded LLMModel
+            mode (str): Placement mode, see `plan_placement`
+            pipeline_size (int): Devices per copy in pipeline mode
+        """
+        self.llm_factory = llm_factory
+        self.mode = mode
+        self.pipeline_size = pipeline_size
+        self.replicas = []
+        self._next = 0
+        self._lock = threading.Lock()
+        # Held for a whole load so concurrent loads cannot leave stray replicas behind
+        self._load_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return bool(self.replicas)
+
+    def load_model(self, model_name_or_path, devices=None):
+        """
+        Load one copy of the model per replica plan.
+
+        Args:
+            model_name_or_path (str): Model ID on Hugging Face or local path
+            devices (list[DeviceSpec]): Devices to place on, defaults to every
+                visible CUDA device
+        """
+        with self._load_lock:
+            if devices is None:
+                devices = discover_devices()
+            plans = plan_placement(devices, self.mode, self.pipeline_size)
+
+            # Free the previous copies first, two sets of weights rarely fit
+            self.stop()
+
+            replicas = []
+            try:
+                for plan in plans:
+                    print(f"Placing replica on {plan.name}")
+                    replica = Replica(plan, self.llm_factory())
+                    replicas.append(replica)
+                    replica.llm.load_model(
+                        model_name_or_path, device_ids=plan.device_ids, max_memory=plan.max_memory
+                    )
+            except Exception:
+                # Stop the copies loaded so far, their schedulers keep the weights alive
+                self._stop_replicas(replicas)
+                raise
+            with self._lock:
+                self.replicas = replicas
+            self._update_metrics()
+        return self
+
+    def select(self):
+        """Return the replica with the least outstanding work."""
+        if not self.replicas:
+            raise ValueError("Model not loaded. Call /load endpoint first.")
+        count = len(self.replicas)
+        index = min(
+            range(count),
+            key=lambda i: (self.replicas[i].load(), (i - self._next) % count),
+        )
+        self._next = (index + 1) % count
+        return self.replicas[index]
+
+    def generate(self, prompt, max_length=100, temperature=0.7, top_p=0.9):
+        """Generate text on the least loaded replica, see `LLMModel.generate`."""
+        replicas = self.replicas
+        if not replicas:
+            raise ValueError("Model not loaded. Call /load endpoint first.")
+        # Every replica runs the same tokenizer, so tokenize before picking one
+        seq = replicas[0].llm.prepare(prompt, max_length, temperature, top_p)
+
+        # Select and enqueue atomically so concurrent requests see each other's load
+        with self._lock:
+            if self.replicas is not replicas:
+                raise RuntimeError("Model was reloaded while the request was being prepared")
+            replica = self.select()
+            replica.llm.enqueue(seq)
+        REPLICA_REQUESTS.labels(device=replica.name).inc()
+        self._update_metrics()
+        try:
+            return replica.llm.wait(seq)
+        finally:
+            self._update_metrics()
+
+    def stop(self):
+        """Stop every replica's scheduler and drop the replicas."""
+        with self._lock:
+            replicas, self.replicas = self.replicas, []
+        self._stop_replicas(replicas)
+
+    def _stop_replicas(self, replicas):
+        for replica in replicas:
+            if replica.llm.scheduler is not None:
+                replica.llm.scheduler.stop()
+            REPLICA_LOAD.labels(device=replica.name).set(0)
+
+    def _update_metrics(self):
+        for replica in self.replicas:
+            REPLICA_LOAD.labels(device=replica.name).set(replica.load())
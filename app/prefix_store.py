@@ -0,0 +1,374 @@
+import hashlib
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+from array import array
+from collections import Counter
+from app.metrics import (
+    PREFIX_STORE_BYTES,
+    PREFIX_STORE_HITS,
+    PREFIX_STORE_EVICTIONS,
+    PREFIX_STORE_DROPPED_WRITES,
+)
+
+INDEX_FILE = "index.json"
+
+
+class PrefixStore:
+    """
+    Disk-backed cache of tokenized prompts and prefix KV snapshots.
+
+    Token IDs of long prompts are stored as .npy arrays keyed by model and
+    prompt text. Keys and values are stored in segments of `segment_size`
+    tokens, each keyed by a hash chained over the model key and every token
+    up to the end of the segment, so a prompt reuses the segments of any
+    earlier prompt it shares a prefix with. Files are memory-mapped when
+    read. The total size is bounded by evicting least recently used entries,
+    taking segments from the end of a chain so the rest stays usable.
+
+    Writes happen on a background thread so the scheduler never waits on disk.
+    At most `max_pending_bytes` of snapshots wait for it, more are dropped,
+    and the index is rewritten once the queue drains rather than per entry.
+    """
+
+    def __init__(self, root, max_bytes, segment_size=256, min_prompt_tokens=256,
+                 max_pending_bytes=1 << 30):
+        """
+        Open or create a store.
+
+        Args:
+            root (str): Directory holding the index and data files
+            max_bytes (int): Size limit for all stored files
+            segment_size (int): Tokens per KV segment, a multiple of the
+                KV cache block size
+            min_prompt_tokens (int): Shorter prompts are not stored
+            max_pending_bytes (int): Size limit for snapshots queued for writing
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.min_prompt_tokens = min_prompt_tokens
+        self.max_pending_bytes = max_pending_bytes
+        os.makedirs(root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Serializes writers of the index file, which happen outside _lock
+        self._index_lock = threading.Lock()
+        self.index = self._read_index()
+        self._index_dirty = False
+        self._pending = set()
+        self._pending_bytes = 0
+        PREFIX_STORE_BYTES.set(self.total_bytes())
+
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    # Tokenized prompts
+
+    def get_tokens(self, model_key, prompt):
+        """Return the cached token IDs of a prompt, or None."""
+        key = self._digest("tokens", model_key, prompt)
+        if not self._touch(key):
+            return None
+        import numpy as np
+        try:
+            token_ids = np.load(self._path(key, ".npy"), mmap_mode="r")
+        except OSError:
+            self._drop(key)
+            return None
+        PREFIX_STORE_HITS.labels(kind="tokens").inc()
+        return token_ids.tolist()
+
+    def put_tokens(self, model_key, prompt, token_ids):
+        """Store the token IDs of a long prompt."""
+        if len(token_ids) < self.min_prompt_tokens:
+            return
+        key = self._digest("tokens", model_key, prompt)
+        if key not in self.index:
+            self._writes.put((self._save_tokens, (key, model_key, list(token_ids))))
+
+    # Prefix KV segments
+
+    def segment_keys(self, model_key, token_ids):
+        """
+        Yield (key, parent_key, start, end) for every full segment of `token_ids`.
+        """
+        digest = hashlib.sha256(model_key.encode())
+        parent = None
+        for start in range(0, len(token_ids) - self.segment_size + 1, self.segment_size):
+            end = start + self.segment_size
+            digest.update(array("q", token_ids[start:end]).tobytes())
+            key = digest.hexdigest()
+            yield key, parent, start, end
+            parent = key
+
+    def match_segments(self, model_key, token_ids):
+        """Return (key, start, end) of the stored segments covering a prefix of `token_ids`."""
+        matched = []
+        with self._lock:
+            for key, _, start, end in self.segment_keys(model_key, token_ids):
+                if key not in self.index:
+                    break
+                matched.append((key, start, end))
+        return matched
+
+    def missing_segments(self, model_key, token_ids):
+        """Return (key, parent_key, start, end) of full segments not stored or queued yet."""
+        with self._lock:
+            return [
+                segment for segment in self.segment_keys(model_key, token_ids)
+                if segment[0] not in self.index and segment[0] not in self._pending
+            ]
+
+    def get_segment(self, key, touch=True):
+        """
+        Memory-map a stored segment.
+
+        Returns:
+            dict: "keys" and "values" of shape (layers, kv_heads, tokens, head_dim)
+                and "token_ids", or None if the segment is gone
+        """
+        if key not in self.index:
+            return None
+        import torch
+        try:
+            segment = torch.load(self._path(key, ".pt"), mmap=True, weights_only=True)
+        except (OSError, RuntimeError):
+            self._drop(key)
+            return None
+        if touch:
+            self._touch(key)
+            PREFIX_STORE_HITS.labels(kind="kv").inc()
+        return segment
+
+    @property
+    def writes_full(self):
+        """Whether queued snapshots already reach `max_pending_bytes`."""
+        with self._lock:
+            return self._pending_bytes >= self.max_pending_bytes
+
+    def put_segment(self, model_key, key, parent, token_ids, keys, values, ready=None):
+        """
+        Queue a KV segment for writing, or drop it if the queue is full.
+
+        Args:
+            keys (torch.Tensor): CPU tensor of shape (layers, kv_heads, tokens, head_dim)
+                that is not a view of a larger tensor
+            values (torch.Tensor): Same layout as `keys`
+            ready (callable): Blocks until `keys` and `values` hold their data,
+                for copies still in flight when the segment is queued
+
+        Returns:
+            bool: Whether the segment was queued
+        """
+        nbytes = keys.numel() * keys.element_size() + values.numel() * values.element_size()
+        with self._lock:
+            if key in self._pending:
+                return True
+            if self._pending_bytes + nbytes > self.max_pending_bytes:
+                PREFIX_STORE_DROPPED_WRITES.inc()
+                return False
+            self._pending.add(key)
+            self._pending_bytes += nbytes
+        self._writes.put((
+            self._save_segment, (model_key, key, parent, list(token_ids), keys, values, ready, nbytes)
+        ))
+        return True
+
+    def top_segments(self, model_key, limit):
+        """
+        Return chains of segment keys to preload, most used first.
+
+        Each of the `limit` most used segments is returned together with its
+        ancestors, root first, since a segment is only usable after them.
+        """
+        with self._lock:
+            entries = {
+                key: entry for key, entry in self.index.items()
+                if entry["kind"] == "kv" and entry["model"] == model_key
+            }
+            ranked = sorted(entries, key=lambda k: (entries[k]["hits"], entries[k]["last_access"]), reverse=True)
+            chains = []
+            seen = set()
+            for key in ranked[:limit]:
+                # Already covered as the ancestor of a higher ranked segment
+                if key in seen:
+                    continue
+                chain = []
+                while key is not None and key in entries:
+                    chain.append(key)
+                    key = entries[key]["parent"]
+                if key is None:
+                    chains.append(chain[::-1])
+                    seen.update(chain)
+            return chains
+
+    # Bookkeeping
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry["bytes"] for entry in self.index.values())
+
+    def flush(self):
+        """Wait for queued writes and persist the index."""
+        self._writes.join()
+        self._write_index()
+
+    def _write_loop(self):
+        while True:
+            fn, args = self._writes.get()
+            try:
+                fn(*args)
+                # Batch index rewrites, one per burst of queued writes
+                if self._writes.empty():
+                    self._write_index()
+            except Exception as e:
+                print(f"Could not write prefix store entry: {e}")
+            finally:
+                self._writes.task_done()
+
+    def _save_tokens(self, key, model_key, token_ids):
+        import numpy as np
+        path = self._path(key, ".npy")
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, np.asarray(token_ids, dtype=np.int64))
+        os.replace(path + ".tmp", path)
+        self._add(key, {"kind": "tokens", "model": model_key, "bytes": os.path.getsize(path)})
+
+    def _save_segment(self, model_key, key, parent, token_ids, keys, values, ready, nbytes):
+        import torch
+        path = self._path(key, ".pt")
+        try:
+            if ready is not None:
+                ready()
+            torch.save(
+                {"keys": keys, "values": values, "token_ids": torch.tensor(token_ids, dtype=torch.long)},
+                path + ".tmp",
+            )
+            os.replace(path + ".tmp", path)
+            self._add(key, {"kind": "kv", "model": model_key, "parent": parent, "bytes": os.path.getsize(path)})
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+                self._pending_bytes -= nbytes
+
+    def _add(self, key, entry):
+        entry.update({"hits": 0, "last_access": time.time()})
+        with self._lock:
+            self.index[key] = entry
+            removed = self._evict_locked()
+            self._index_dirty = True
+        self._remove_files(removed)
+        PREFIX_STORE_BYTES.set(self.total_bytes())
+
+    def _touch(self, key):
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return False
+            entry["hits"] += 1
+            entry["last_access"] = time.time()
+            self._index_dirty = True
+            return True
+
+    def _drop(self, key):
+        """Remove an unreadable entry and the segments that can only be reached through it."""
+        with self._lock:
+            removed = []
+            children = {}
+            for child, entry in self.index.items():
+                children.setdefault(entry.get("parent"), []).append(child)
+            stack = [key]
+            while stack:
+                key = stack.pop()
+                stack.extend(children.get(key, ()))
+                removed += self._remove_locked(key)
+            self._index_dirty = True
+        self._remove_files(removed)
+        # The writer thread persists the index
+        self._writes.put((self._write_index, ()))
+
+    def _evict_locked(self):
+        """
+        Remove least recently used entries from the index, returning their files.
+
+        Only entries nothing else depends on are candidates, so a chain of
+        segments is evicted from its last segment towards its first.
+        """
+        removed = []
+        total = sum(entry["bytes"] for entry in self.index.values())
+        if total <= self.max_bytes:
+            return removed
+        num_children = Counter(entry.get("parent") for entry in self.index.values())
+        leaves = [(entry["last_access"], key) for key, entry in self.index.items() if not num_children[key]]
+        heapq.heapify(leaves)
+        while leaves and total > self.max_bytes:
+            _, key = heapq.heappop(leaves)
+            parent = self.index[key].get("parent")
+            total -= self.index[key]["bytes"]
+            removed += self._remove_locked(key)
+            PREFIX_STORE_EVICTIONS.inc()
+            num_children[parent] -= 1
+            if parent in self.index and not num_children[parent]:
+                heapq.heappush(leaves, (self.index[parent]["last_access"], parent))
+        return removed
+
+    def _remove_locked(self, key):
+        """Remove an entry from the index, returning its file to delete once the lock is released."""
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return []
+        return [self._path(key, ".npy" if entry["kind"] == "tokens" else ".pt")]
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _read_index(self):
+        path = os.path.join(self.root, INDEX_FILE)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable prefix store index: {e}")
+            return {}
+        # Drop entries whose data file did not survive
+        return {
+            key: entry for key, entry in index.items()
+            if os.path.exists(self._path(key, ".npy" if entry["kind"] == "tokens" else ".pt"))
+        }
+
+    def _write_index(self):
+        """Persist the index if it changed, holding `_lock` only to copy it."""
+        with self._index_lock:
+            with self._lock:
+                if not self._index_dirty:
+                    return
+                index = {key: dict(entry) for key, entry in self.index.items()}
+                self._index_dirty = False
+            path = os.path.join(self.root, INDEX_FILE)
+            try:
+                with open(path + ".tmp", "w") as f:
+                    json.dump(index, f)
+                os.replace(path + ".tmp", path)
+            except OSError:
+                with self._lock:
+                    self._index_dirty = True
+                raise
+
+    def _path(self, key, suffix):
+        return os.path.join(self.root, key + suffix)
+
+    @staticmethod
+    def _digest(*parts):
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
@@ -0,0 +1,619 @@
+import threading
+import time
+import torch
+from app.kv_cache import BlockTable, OutOfBlocksError
+from app.paged_attention import paged_forward, supports_paged_attention
+from app.metrics import (
+    TIME_TO_FIRST_TOKEN,
+    INTER_TOKEN_LATENCY,
+    PREFILL_CHUNKS,
+    PREFILL_CHUNK_SIZE,
+    RUNNING_SEQUENCES,
+    KV_CACHE_PREEMPTIONS,
+    KV_CACHE_PREFIX_HIT_TOKENS,
+    PREFIX_STORE_DROPPED_WRITES,
+)
+
+
+def sample_next_token(logits, temperature=0.7, top_p=0.9):
+    """
+    Sample a token ID from the logits of the last position.
+
+    Args:
+        logits (torch.Tensor): Logits of shape (vocab_size,)
+        temperature (float): Sampling temperature, <= 0 means greedy
+        top_p (float): Nucleus sampling parameter
+
+    Returns:
+        int: Sampled token ID
+    """
+    if temperature is None or temperature <= 0:
+        return int(torch.argmax(logits, dim=-1))
+
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p is not None and top_p < 1.0:
+        sorted_probs, sorted_indices = torch.sort(probs, descending=True)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+        # Drop tokens once the mass before them already exceeds top_p,
+        # which always keeps the most likely token.
+        sorted_probs[(cumulative - sorted_probs) > top_p] = 0.0
+        choice = torch.multinomial(sorted_probs / sorted_probs.sum(), num_samples=1)
+        return int(sorted_indices[choice])
+    return int(torch.multinomial(probs, num_samples=1))
+
+
+def _to_model_cache(past_key_values):
+    """Wrap legacy tuple caches for transformers versions that expect Cache objects."""
+    if past_key_values is None or not isinstance(past_key_values, tuple):
+        return past_key_values
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past_key_values
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    # Newer versions dropped the legacy conversions, fill the cache layer by layer
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(past_key_values):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return past_key_values
+
+
+def _copy_to_host(layers):
+    """
+    Start copying per-layer tensors into one CPU tensor without waiting for the device.
+
+    Args:
+        layers (list[torch.Tensor]): One (kv_heads, tokens, head_dim) tensor per
+            layer, layers of a pipeline-split model live on different devices
+
+    Returns:
+        tuple: CPU tensor of shape (layers, kv_heads, tokens, head_dim) and the
+            set of CUDA devices the copy may still be in flight on
+    """
+    pinned = any(layer.is_cuda for layer in layers)
+    host = torch.empty((len(layers),) + tuple(layers[0].shape), dtype=layers[0].dtype, pin_memory=pinned)
+    devices = set()
+    for target, layer in zip(host, layers):
+        # Later kernels on the same stream run after the copy, so the source
+        # may be overwritten or freed as soon as the copy is queued
+        target.copy_(layer, non_blocking=layer.is_cuda)
+        if layer.is_cuda:
+            devices.add(layer.device)
+    return host, devices
+
+
+def _copy_waiter(devices):
+    """Return a callable blocking until the work queued so far on `devices` is done, or None."""
+    if not devices:
+        return None
+    events = []
+    for device in devices:
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(device))
+        events.append(event)
+
+    def wait():
+        for event in events:
+            event.synchronize()
+
+    return wait
+
+
+class Sequence:
+    """A single generation request tracked by the scheduler."""
+
+    def __init__(self, input_ids, max_new_tokens=100, temperature=0.7, top_p=0.9,
+                 eos_token_id=None):
+        """
+        Initialize the sequence.
+
+        Args:
+            input_ids (list[int]): Prompt token IDs
+            max_new_tokens (int): Maximum number of tokens to generate
+            temperature (float): Sampling temperature
+            top_p (float): Nucleus sampling parameter
+            eos_token_id (int): Token ID that ends generation early
+        """
+        self.input_ids = list(input_ids)
+        self.output_ids = []
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.eos_token_id = eos_token_id
+
+        # Number of leading tokens whose keys and values are cached
+        self.num_computed = 0
+        self.past_key_values = None
+        self.block_table = BlockTable()
+
+        self.arrival_time = time.perf_counter()
+        self.first_token_time = None
+        self.token_times = []
+
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def prefill_ids(self):
+        """
+        Tokens that must be in the cache before the next decode step.
+
+        This is the prompt, plus all but the last generated token when a
+        preempted sequence is recomputed.
+        """
+        return self.input_ids + self.output_ids[:-1]
+
+    @property
+    def is_prefilling(self):
+        return self.num_computed < len(self.input_ids) + max(len(self.output_ids) - 1, 0)
+
+    @property
+    def remaining_tokens(self):
+        """Prompt tokens left to prefill plus tokens left to generate."""
+        num_cached = len(self.input_ids) + max(len(self.output_ids) - 1, 0)
+        return num_cached - self.num_computed + self.max_new_tokens - len(self.output_ids)
+
+    @property
+    def ttft(self):
+        """Time to first token in seconds, or None if no token was produced."""
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.arrival_time
+
+    @property
+    def inter_token_latencies(self):
+        """Gaps in seconds between consecutive generated tokens."""
+        return [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+
+
+class ChunkedPrefillScheduler:
+    """
+    Interleaves chunked prompt prefill with decode steps of in-flight sequences.
+
+    Each scheduler step first advances every decoding sequence by one token,
+    then spends at most `prefill_chunk_size` prompt tokens on sequences that
+    are still prefilling. A long prompt therefore takes several steps to
+    prefill, but never stalls token output of the other sequences for longer
+    than one chunk. Decode steps run as one batched forward pass with the
+    paged KV cache and one sequence at a time without it.
+
+    With a paged KV cache, sequences are only admitted while their prompt
+    fits in free blocks, and a sequence that runs out of blocks while
+    decoding is preempted and later recomputed from its tokens.
+    """
+
+    def __init__(self, model, device, prefill_chunk_size=512, max_num_seqs=8, kv_cache=None,
+                 prefix_store=None, model_key=""):
+        """
+        Initialize the scheduler.
+
+        Args:
+            model: Causal LM returning logits and past_key_values
+            device (str): Device the input tensors are placed on
+            prefill_chunk_size (int): Prompt token budget per step, 0 or None
+                prefills each prompt in a single step
+            max_num_seqs (int): Maximum number of sequences in flight
+            kv_cache (PagedKVCache): Block pool holding the sequences' keys and
+                values, None keeps a contiguous cache per sequence
+            prefix_store (PrefixStore): Disk store prompt prefixes are restored
+                from and snapshotted to
+            model_key (str): Identifies the model and dtype in `prefix_store`
+        """
+        if kv_cache is not None and not supports_paged_attention(model, kv_cache, device):
+            raise ValueError(
+                f"{type(model).__name__} does not read its keys and values through the "
+                "transformers Cache API, so it cannot run on the paged KV cache. "
+                "Set KV_CACHE_MEMORY_MB=0 or upgrade transformers."
+            )
+        self.model = model
+        self.kv_cache = kv_cache
+        self.prefix_store = prefix_store
+        self.model_key = model_key
+        self.device = device
+        self.prefill_chunk_size = prefill_chunk_size or 0
+        self.max_num_seqs = max_num_seqs
+        # Device and dtype of each layer's keys and values, see _layer_placement
+        self._placement = None
+
+        self.waiting = []
+        self.running = []
+
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        PREFILL_CHUNK_SIZE.set(self.prefill_chunk_size)
+
+    def submit(self, seq):
+        """Queue a sequence and wake up the background loop."""
+        with self._cond:
+            self.waiting.append(seq)
+            self._cond.notify()
+        return seq
+
+    def has_work(self):
+        return bool(self.waiting or self.running)
+
+    def load(self):
+        """Outstanding work of every queued and running sequence, in tokens."""
+        with self._cond:
+            return sum(seq.remaining_tokens for seq in self.waiting + self.running)
+
+    def start(self):
+        """Start the background scheduling thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and fail any unfinished sequences."""
+        self._stop_event.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=5)
+        self._fail_all(RuntimeError("Scheduler stopped"))
+
+    def preload_prefixes(self, limit):
+        """
+        Restore the most used stored prefixes into the KV cache.
+
+        The restored blocks are released right away but keep their prefix
+        hashes, so they serve later prompts until the space is needed. Only
+        as many chains as fit in the free blocks are restored, least used
+        first, so the most used ones are released last and reused last.
+
+        Only the paged KV cache keeps blocks around between sequences, so
+        nothing is preloaded with the dynamic cache.
+
+        Returns:
+            int: Number of tokens restored
+        """
+        if self.prefix_store is None or self.kv_cache is None:
+            return 0
+        store = self.prefix_store
+        blocks_per_segment = -(-store.segment_size // self.kv_cache.block_size)
+        budget = self.kv_cache.blocks.allocator.num_free
+        chains = []
+        counted = set()
+        for chain in store.top_segments(self.model_key, limit):
+            # Ancestors shared with a chain already selected take no new blocks
+            new_keys = [key for key in chain if key not in counted]
+            if len(new_keys) * blocks_per_segment > budget:
+                break
+            budget -= len(new_keys) * blocks_per_segment
+            counted.update(new_keys)
+            chains.append(chain)
+
+        restored = 0
+        for chain in reversed(chains):
+            segments = []
+            for i, key in enumerate(chain):
+                segment = store.get_segment(key, touch=False)
+                if segment is None:
+                    break
+                start = i * store.segment_size
+                segments.append((start, start + store.segment_size, segment))
+            token_ids = [t for _, _, segment in segments for t in segment["token_ids"].tolist()]
+
+            table = BlockTable()
+            matched = self.kv_cache.blocks.match_prefix(table, token_ids)
+            try:
+                self._restore_segments(table, segments)
+            except Exception as e:
+                print(f"Could not preload stored prefix: {e}")
+            restored += table.num_tokens - matched
+            self.kv_cache.free(table)
+        return restored
+
+    def run_until_complete(self):
+        """Run steps on the calling thread until every sequence finished."""
+        while self.has_work():
+            self.step()
+
+    def step(self):
+        """Run one scheduling iteration: decode steps, then prefill chunks."""
+        admitted = []
+        with self._cond:
+            while self.waiting and len(self.running) < self.max_num_seqs:
+                seq = self.waiting[0]
+                if seq.max_new_tokens <= 0:
+                    # Nothing to generate, the prompt is returned unchanged
+                    self.waiting.pop(0)
+                    self._finish(seq)
+                    continue
+                if self.kv_cache is not None and not self._allocate_prefix(seq):
+                    if self.running:
+                        break
+                    # Nothing can free blocks, so this prompt will never fit
+                    self.waiting.pop(0)
+                    self._finish(seq, OutOfBlocksError("Prompt does not fit in the KV cache"))
+                    continue
+                self.waiting.pop(0)
+                self.running.append(seq)
+                admitted.append(seq)
+            running = list(self.running)
+        RUNNING_SEQUENCES.set(len(running))
+
+        # Disk reads happen outside the lock so submit() never waits on them.
+        # Blocks are only touched by this thread, and nothing runs the new
+        # sequences before their prefix is restored below.
+        if self.prefix_store is not None:
+            for seq in admitted:
+                self._restore_from_store(seq)
+
+        with torch.no_grad():
+            self._decode([seq for seq in running if not seq.is_prefilling])
+
+            budget = self.prefill_chunk_size
+            for seq in running:
+                if not seq.is_prefilling or seq.done.is_set() or seq not in self.running:
+                    continue
+                remaining = len(seq.prefill_ids) - seq.num_computed
+                chunk = remaining if not self.prefill_chunk_size else min(remaining, budget)
+                if chunk <= 0:
+                    break
+                self._run_guarded(seq, self._prefill_chunk, seq, chunk)
+                if self.prefill_chunk_size:
+                    budget -= chunk
+
+        with self._cond:
+            self.running = [seq for seq in self.running if not seq.done.is_set()]
+
+    def _loop(self):
+        """Background loop that steps while there is work to do."""
+        while not self._stop_event.is_set():
+            with self._cond:
+                while not self.has_work() and not self._stop_event.is_set():
+                    self._cond.wait()
+            if self._stop_event.is_set():
+                break
+            try:
+                self.step()
+            except Exception as e:
+                # Model errors are handled per sequence, so this is a scheduling
+                # bug. Fail everything in flight instead of leaving callers waiting.
+                print(f"Scheduler step failed: {e}")
+                self._fail_all(e)
+
+    def _fail_all(self, error):
+        """Finish every queued and running sequence with an error."""
+        with self._cond:
+            seqs = self.waiting + self.running
+            self.waiting = []
+            self.running = []
+        for seq in seqs:
+            try:
+                self._finish(seq, error)
+            except Exception as e:
+                print(f"Could not release sequence: {e}")
+
+    def _run_guarded(self, seq, fn, *args):
+        """Run a model step, finishing the sequence with the error on failure."""
+        try:
+            fn(*args)
+        except OutOfBlocksError as e:
+            self._preempt(seq, e)
+        except Exception as e:
+            self._finish(seq, e)
+
+    def _allocate_prefix(self, seq):
+        """
+        Attach shared prefix blocks and check the rest of the prompt fits.
+
+        Segments from the prefix store are restored later, outside the lock.
+        """
+        blocks = self.kv_cache.blocks
+        matched = blocks.match_prefix(seq.block_table, seq.prefill_ids)
+        # One extra slot so the first decode step does not preempt right away
+        if not blocks.can_allocate(len(seq.prefill_ids) - matched + 1):
+            self.kv_cache.free(seq.block_table)
+            return False
+        KV_CACHE_PREFIX_HIT_TOKENS.inc(matched)
+        seq.num_computed = seq.block_table.num_tokens
+        return True
+
+    def _restore_from_store(self, seq):
+        """Extend a sequence's cached prefix with segments stored on disk."""
+        # Leave the last prompt token to the model, like in-memory prefix matching
+        matches = self.prefix_store.match_segments(self.model_key, seq.prefill_ids[:-1])
+        segments = []
+        for key, start, end in matches:
+            if end <= seq.num_computed:
+                continue
+            segment = self.prefix_store.get_segment(key)
+            if segment is None:
+                break
+            segments.append((start, end, segment))
+        if not segments:
+            return
+        try:
+            if self.kv_cache is None:
+                self._restore_past_key_values(seq, segments)
+            else:
+                self._restore_segments(seq.block_table, segments)
+        except Exception as e:
+            print(f"Could not restore stored prefix: {e}")
+        if self.kv_cache is not None:
+            # Keep whatever was written before a failure
+            seq.num_computed = seq.block_table.num_tokens
+
+    def _restore_segments(self, table, segments):
+        """Write the part of consecutive (start, end, segment) entries not yet in `table`."""
+        for start, end, segment in segments:
+            if end <= table.num_tokens:
+                continue
+            offset = table.num_tokens - start
+            token_ids = segment["token_ids"][offset:].tolist()
+            self.kv_cache.reserve(table, len(token_ids))
+            self.kv_cache.write_tensors(
+                table, segment["keys"][:, :, offset:], segment["values"][:, :, offset:], token_ids
+            )
+
+    def _restore_past_key_values(self, seq, segments):
+        """Start a sequence's dynamic cache from consecutive segments beginning at position 0."""
+        keys = torch.cat([segment["keys"] for _, _, segment in segments], dim=2)
+        values = torch.cat([segment["values"] for _, _, segment in segments], dim=2)
+        placement = self._layer_placement()
+        if len(placement) != keys.shape[0]:
+            raise ValueError(f"Stored prefix has {keys.shape[0]} layers, the model has {len(placement)}")
+        seq.past_key_values = tuple(
+            (keys[i:i + 1].to(device, dtype), values[i:i + 1].to(device, dtype))
+            for i, (device, dtype) in enumerate(placement)
+        )
+        seq.num_computed = segments[-1][1]
+
+    def _layer_placement(self):
+        """Device and dtype of each layer's keys and values, learned from a one-token forward pass."""
+        if self._placement is None:
+            with torch.no_grad():
+                outputs = self.model(
+                    input_ids=torch.zeros((1, 1), dtype=torch.long, device=self.device), use_cache=True
+                )
+            self._placement = [
+                (keys.device, keys.dtype) for keys, _ in _to_legacy_cache(outputs.past_key_values)
+            ]
+        return self._placement
+
+    def _snapshot_prefix(self, seq):
+        """Queue the prompt's segments that are not on disk yet for writing."""
+        if len(seq.input_ids) < self.prefix_store.min_prompt_tokens:
+            return
+        layers = _to_legacy_cache(seq.past_key_values) if self.kv_cache is None else None
+        for key, parent, start, end in self.prefix_store.missing_segments(self.model_key, seq.input_ids):
+            # Later segments are useless without this one
+            if self.prefix_store.writes_full:
+                PREFIX_STORE_DROPPED_WRITES.inc()
+                break
+            if layers is None:
+                keys, values = self.kv_cache.read(seq.block_table, start, end)
+            else:
+                keys = [k[0, :, start:end] for k, _ in layers]
+                values = [v[0, :, start:end] for _, v in layers]
+            keys, key_devices = _copy_to_host(list(keys))
+            values, value_devices = _copy_to_host(list(values))
+            if not self.prefix_store.put_segment(
+                self.model_key, key, parent, seq.input_ids[start:end], keys, values,
+                ready=_copy_waiter(key_devices | value_devices),
+            ):
+                break
+
+    def _preempt(self, seq, error):
+        """Release a sequence's blocks and requeue it for recomputation."""
+        with self._cond:
+            if len(self.running) <= 1:
+                # It is alone and still does not fit, recomputing cannot help
+                self._finish(seq, error)
+                return
+            self.kv_cache.free(seq.block_table)
+            seq.num_computed = 0
+            self.running.remove(seq)
+            self.waiting.insert(0, seq)
+        KV_CACHE_PREEMPTIONS.inc()
+
+    def _forward(self, seq, token_ids):
+        if self.kv_cache is not None:
+            self.kv_cache.reserve(seq.block_table, len(token_ids))
+            logits = paged_forward(self.model, self.kv_cache, [seq.block_table], [token_ids], self.device)
+            seq.num_computed += len(token_ids)
+            return logits[0]
+
+        input_ids = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            past_key_values=_to_model_cache(seq.past_key_values),
+            use_cache=True,
+        )
+        seq.past_key_values = outputs.past_key_values
+        seq.num_computed += len(token_ids)
+        return outputs.logits[0, -1, :]
+
+    def _prefill_chunk(self, seq, chunk):
+        start = seq.num_computed
+        logits = self._forward(seq, seq.prefill_ids[start:start + chunk])
+        PREFILL_CHUNKS.inc()
+
+        if not seq.is_prefilling and not seq.output_ids:
+            if self.prefix_store is not None:
+                self._snapshot_prefix(seq)
+            # The last prompt position yields the first generated token
+            self._append_token(seq, logits)
+
+    def _decode(self, seqs):
+        """
+        Generate one token for each decoding sequence.
+
+        With a paged KV cache all of them run in one batched forward pass.
+        The dynamic cache keeps one tensor per sequence, so they run one at
+        a time and concurrency only hides prefill, not decode.
+        """
+        if self.kv_cache is None:
+            for seq in seqs:
+                self._run_guarded(seq, self._decode_step, seq)
+            return
+
+        batch = []
+        for seq in seqs:
+            try:
+                self.kv_cache.reserve(seq.block_table, 1)
+            except OutOfBlocksError as e:
+                self._preempt(seq, e)
+                continue
+            except Exception as e:
+                self._finish(seq, e)
+                continue
+            batch.append(seq)
+        # A preempted sequence freed its blocks, but the others keep their slot
+        batch = [seq for seq in batch if seq in self.running and not seq.done.is_set()]
+        if not batch:
+            return
+        try:
+            logits = paged_forward(
+                self.model, self.kv_cache, [seq.block_table for seq in batch],
+                [seq.output_ids[-1:] for seq in batch], self.device,
+            )
+        except Exception as e:
+            for seq in batch:
+                self._finish(seq, e)
+            return
+        for seq, seq_logits in zip(batch, logits):
+            seq.num_computed += 1
+            self._run_guarded(seq, self._append_token, seq, seq_logits)
+
+    def _decode_step(self, seq):
+        logits = self._forward(seq, seq.output_ids[-1:])
+        self._append_token(seq, logits)
+
+    def _append_token(self, seq, logits):
+        token_id = sample_next_token(logits, seq.temperature, seq.top_p)
+        now = time.perf_counter()
+        if seq.first_token_time is None:
+            seq.first_token_time = now
+            TIME_TO_FIRST_TOKEN.observe(now - seq.arrival_time)
+        else:
+            INTER_TOKEN_LATENCY.observe(now - seq.token_times[-1])
+        seq.token_times.append(now)
+        seq.output_ids.append(token_id)
+
+        if len(seq.output_ids) >= seq.max_new_tokens or token_id == seq.eos_token_id:
+            self._finish(seq)
+
+    def _finish(self, seq, error=None):
+        seq.error = error
+        seq.past_key_values = None
+        try:
+            if self.kv_cache is not None:
+                self.kv_cache.free(seq.block_table)
+        finally:
+            seq.done.set()
@@ -2,11 +2,12 @@ import os
 import time
 import json
 import logging
+from contextlib import asynccontextmanager
 from typing import List, Optional, Dict, Any
 
-import torch
 from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from prometheus_client import Counter, Histogram, start_http_server
 import redis
@@ -15,73 +16,6 @@ import uvicorn
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Qwen 32B Coder API", version="1.0.0")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Try to connect to Redis, use a mock if it fails
-try:
-    redis_client = redis.Redis(
-        host=os.getenv("REDIS_HOST", "localhost"),
-        port=int(os.getenv("REDIS_PORT", 6379)),
-        db=0,
-        decode_responses=True,
-        socket_connect_timeout=1  # Short timeout for quick failure
-    )
-    # Test connection
-    redis_client.ping()
-    logger.info("Connected to Redis successfully")
-except Exception as e:
-    logger.warning(f"Failed to connect to Redis: {str(e)}. Using mock Redis client.")
-    # Create a simple mock Redis client
-    class MockRedis:
-        def __init__(self):
-            self.data = {}
-            self.expirations = {}
-            
-        def get(self, key):
-            return self.data.get(key)
-            
-        def set(self, key, value, ex=None):
-            self.data[key] = value
-            if ex:
-                self.expirations[key] = time.time() + ex
-            return True
-            
-        def incr(self, key):
-            if key not in self.data:
-                self.data[key] = 1
-            else:
-                self.data[key] = int(self.data[key]) + 1
-            return self.data[key]
-            
-        def expire(self, key, time_seconds):
-            self.expirations[key] = time.time() + time_seconds
-            return True
-            
-        def incrby(self, key, amount):
-            if key not in self.data:
-                self.data[key] = amount
-            else:
-                self.data[key] = int(self.data[key]) + amount
-            return self.data[key]
-    
-    redis_client = MockRedis()
-    logger.info("Using mock Redis client")
-
-# Start Prometheus metrics server on port 8006
-try:
-    start_http_server(8006)
-    logger.info("Started Prometheus metrics server on port 8006")
-except Exception as e:
-    logger.warning(f"Failed to start Prometheus metrics server: {str(e)}")
-
 REQUESTS = Counter("llm_requests_total", "Total number of requests", ["endpoint", "status"])
 LATENCY = Histogram("llm_request_latency_seconds", "Request latency in seconds", ["endpoint"])
 TOKENS_GENERATED = Counter("llm_tokens_generated_total", "Total number of tokens generated")
@@ -107,12 +41,90 @@ class GenerateResponse(BaseModel):
     choices: List[Dict[str, Any]] = Field(..., description="Generated text choices")
     usage: Dict[str, int] = Field(..., description="Token usage statistics")
 
+class MockRedis:
+    """In-memory stand-in used when Redis is unreachable."""
+    def __init__(self):
+        self.data = {}
+        self.expirations = {}
+        
+    def get(self, key):
+        return self.data.get(key)
+        
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        if ex:
+            self.expirations[key] = time.time() + ex
+        return True
+        
+    def incr(self, key):
+        if key not in self.data:
+            self.data[key] = 1
+        else:
+            self.data[key] = int(self.data[key]) + 1
+        return self.data[key]
+        
+    def expire(self, key, time_seconds):
+        self.expirations[key] = time.time() + time_seconds
+        return True
+        
+    def incrby(self, key, amount):
+        if key not in self.data:
+            self.data[key] = amount
+        else:
+            self.data[key] = int(self.data[key]) + amount
+        return self.data[key]
+
+def connect_redis():
+    """Connect to Redis, falling back to a mock client if it is unreachable."""
+    try:
+        client = redis.Redis(
+            host=os.getenv("REDIS_HOST", "localhost"),
+            port=int(os.getenv("REDIS_PORT", 6379)),
+            db=0,
+            decode_responses=True,
+            socket_connect_timeout=1  # Short timeout for quick failure
+        )
+        # Test connection
+        client.ping()
+        logger.info("Connected to Redis successfully")
+        return client
+    except Exception as e:
+        logger.warning(f"Failed to connect to Redis: {str(e)}. Using mock Redis client.")
+        return MockRedis()
+
 def load_model():
     logger.info(f"Loading model: {MODEL_NAME}")
     
     return "mock_model"
 
-model = load_model()
+# Set during lifespan startup; nothing touches the network at import time
+redis_client = None
+model = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global redis_client, model
+    
+    # Start Prometheus metrics server on port 8006
+    try:
+        start_http_server(8006)
+        logger.info("Started Prometheus metrics server on port 8006")
+    except Exception as e:
+        logger.warning(f"Failed to start Prometheus metrics server: {str(e)}")
+    
+    redis_client = connect_redis()
+    model = load_model()
+    yield
+
+app = FastAPI(title="Qwen 32B Coder API", version="1.0.0", lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 async def check_rate_limit(request: Request, api_key_id: str = None):
     if not api_key_id:
@@ -153,6 +165,12 @@ async def root():
 async def health():
     return {"status": "healthy", "model": MODEL_NAME}
 
+@app.get("/ready")
+async def ready():
+    if redis_client is None or model is None:
+        return JSONResponse(status_code=503, content={"status": "not_ready", "model": MODEL_NAME})
+    return {"status": "ready", "model": MODEL_NAME}
+
 @app.post("/generate", response_model=GenerateResponse)
 async def generate(
     request: GenerateRequest,
@@ -0,0 +1,127 @@
+"""
+Benchmark chunked prefill on a tiny CPU model.
+
+Mixes long repository-context style prompts with short prompts that keep
+arriving while the long ones are being prefilled, and reports how the
+prefill chunk size trades time to first token (TTFT) against inter-token
+latency (ITL).
+
+Usage:
+    python tests/benchmark_chunked_prefill.py
+    python tests/benchmark_chunked_prefill.py --chunk-sizes 0 64 256 --long-len 1536
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.scheduler import ChunkedPrefillScheduler, Sequence
+from conftest import build_tiny_gpt2
+
+
+def build_workload(num_long, num_short, long_len, short_len, arrival_gap):
+    """
+    Build a list of (arrival_step, prompt_len) pairs.
+
+    Long prompts arrive every few steps while short prompts arrive in
+    between, so decoding short requests overlap with long prefills.
+    """
+    workload = []
+    for i in range(num_long):
+        workload.append((i * arrival_gap * 4, long_len))
+    for i in range(num_short):
+        workload.append((i * arrival_gap, short_len))
+    return sorted(workload)
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run(model, chunk_size, workload, max_new_tokens, max_num_seqs):
+    """Replay the workload through a scheduler and collect latencies."""
+    scheduler = ChunkedPrefillScheduler(
+        model, "cpu", prefill_chunk_size=chunk_size, max_num_seqs=max_num_seqs
+    )
+    rng = random.Random(0)
+    pending = list(workload)
+    sequences = []
+    step = 0
+    start = time.perf_counter()
+    while pending or scheduler.has_work():
+        while pending and pending[0][0] <= step:
+            _, prompt_len = pending.pop(0)
+            input_ids = [rng.randrange(model.config.vocab_size) for _ in range(prompt_len)]
+            seq = Sequence(input_ids, max_new_tokens=max_new_tokens, temperature=0)
+            sequences.append((prompt_len, scheduler.submit(seq)))
+        scheduler.step()
+        step += 1
+    elapsed = time.perf_counter() - start
+
+    long_len = max(prompt_len for prompt_len, _ in sequences)
+    short_ttft = [s.ttft for n, s in sequences if n < long_len]
+    long_ttft = [s.ttft for n, s in sequences if n == long_len]
+    itl = [gap for _, s in sequences for gap in s.inter_token_latencies]
+    return {
+        "chunk_size": chunk_size,
+        "short_ttft_p50": percentile(short_ttft, 50),
+        "short_ttft_p95": percentile(short_ttft, 95),
+        "long_ttft_p50": percentile(long_ttft, 50),
+        "itl_p50": percentile(itl, 50),
+        "itl_p95": percentile(itl, 95),
+        "itl_max": max(itl) if itl else float("nan"),
+        "tokens_per_second": sum(len(s.output_ids) for _, s in sequences) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[0, 32, 64, 128, 256])
+    parser.add_argument("--long-len", type=int, default=1024)
+    parser.add_argument("--short-len", type=int, default=32)
+    parser.add_argument("--num-long", type=int, default=3)
+    parser.add_argument("--num-short", type=int, default=12)
+    parser.add_argument("--arrival-gap", type=int, default=4, help="Steps between short arrivals")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--max-num-seqs", type=int, default=8)
+    args = parser.parse_args()
+
+    torch.set_num_threads(max(1, os.cpu_count() // 2))
+    model = build_tiny_gpt2(
+        vocab_size=1024, max_positions=args.long_len + args.max_new_tokens,
+        hidden_size=128, num_layers=4, num_heads=4,
+    )
+    workload = build_workload(
+        args.num_long, args.num_short, args.long_len, args.short_len, args.arrival_gap
+    )
+
+    # Warm up kernels so the first configuration is not penalized
+    run(model, 0, [(0, args.short_len)], 4, 1)
+
+    header = (
+        f"{'chunk':>6} {'short TTFT p50':>15} {'short TTFT p95':>15} {'long TTFT p50':>14} "
+        f"{'ITL p50':>9} {'ITL p95':>9} {'ITL max':>9} {'tok/s':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for chunk_size in args.chunk_sizes:
+        r = run(model, chunk_size, workload, args.max_new_tokens, args.max_num_seqs)
+        label = str(chunk_size) if chunk_size else "off"
+        print(
+            f"{label:>6} {r['short_ttft_p50'] * 1000:>13.1f}ms {r['short_ttft_p95'] * 1000:>13.1f}ms "
+            f"{r['long_ttft_p50'] * 1000:>12.1f}ms {r['itl_p50'] * 1000:>7.1f}ms "
+            f"{r['itl_p95'] * 1000:>7.1f}ms {r['itl_max'] * 1000:>7.1f}ms {r['tokens_per_second']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Benchmark how many sequences fit concurrently in a fixed KV cache budget.
+
+Replays a backlog of mixed-length requests, half of them starting with a
+shared system prompt, against two allocation strategies:
+
+- contiguous: today's behaviour, every sequence holds one contiguous region
+  large enough for its prompt plus `max_new_tokens`, placed first-fit
+- paged: the BlockManager from app.kv_cache, allocating fixed-size blocks
+  on demand and sharing blocks of common prefixes. Attention reads each
+  layer's keys and values from the pool by slot, so the workspace one
+  layer needs for `--max-num-seqs` of the longest sequences is taken out
+  of the paged budget first
+
+No model runs; every step each running sequence produces one token, so the
+numbers isolate the memory manager.
+
+Usage:
+    python tests/benchmark_kv_cache.py
+    python tests/benchmark_kv_cache.py --memory-gb 8 --block-size 32
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.kv_cache import BlockManager, BlockTable, OutOfBlocksError, PagedKVCache
+
+# Phi-2 in float16: 32 layers, 32 KV heads of size 80
+DEFAULT_GEOMETRY = (32, 32, 80, 2)
+
+
+def build_requests(num_requests, system_prompt_len, max_new_tokens, seed=0):
+    """Return (prompt_ids, output_len) pairs with mixed prompt lengths."""
+    rng = random.Random(seed)
+    system_prompt = [rng.randrange(50000) for _ in range(system_prompt_len)]
+    requests = []
+    for _ in range(num_requests):
+        if rng.random() < 0.3:
+            prompt_len = rng.randint(1024, 4096)
+        else:
+            prompt_len = rng.randint(32, 512)
+        prompt = [rng.randrange(50000) for _ in range(prompt_len)]
+        if rng.random() < 0.5:
+            prompt = system_prompt + prompt
+        requests.append((prompt, rng.randint(16, max_new_tokens)))
+    return requests
+
+
+class ContiguousAllocator:
+    """First-fit allocator over a linear token address space."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.regions = {}  # start -> length
+
+    def allocate(self, length):
+        """Return the start of the first hole that fits, or None."""
+        cursor = 0
+        for start in sorted(self.regions):
+            if start - cursor >= length:
+                break
+            cursor = start + self.regions[start]
+        else:
+            if self.capacity - cursor < length:
+                return None
+        self.regions[cursor] = length
+        return cursor
+
+    def free(self, start):
+        del self.regions[start]
+
+
+def simulate_contiguous(requests, capacity, max_new_tokens):
+    allocator = ContiguousAllocator(capacity)
+    waiting = list(requests)
+    running = []  # [start, remaining_tokens]
+    concurrency = []
+    while waiting or running:
+        while waiting:
+            prompt, output_len = waiting[0]
+            start = allocator.allocate(len(prompt) + max_new_tokens)
+            if start is None:
+                if not running:
+                    # Can never fit, drop it like an OOM error would
+                    waiting.pop(0)
+                    continue
+                break
+            waiting.pop(0)
+            running.append([start, output_len])
+        concurrency.append(len(running))
+        for seq in running:
+            seq[1] -= 1
+        for seq in [s for s in running if s[1] <= 0]:
+            allocator.free(seq[0])
+            running.remove(seq)
+    return {"concurrency": concurrency, "preemptions": 0}
+
+
+def simulate_paged(requests, num_blocks, block_size):
+    manager = BlockManager(num_blocks, block_size)
+    waiting = [(prompt, output_len, BlockTable()) for prompt, output_len in requests]
+    running = []  # [prompt, remaining_tokens, table]
+    concurrency = []
+    preemptions = 0
+    while waiting or running:
+        while waiting:
+            prompt, output_len, table = waiting[0]
+            matched = manager.match_prefix(table, prompt)
+            if not manager.can_allocate(len(prompt) - matched + 1):
+                manager.free(table)
+                if not running:
+                    waiting.pop(0)
+                    continue
+                break
+            waiting.pop(0)
+            manager.reserve(table, len(prompt) - matched)
+            manager.append_tokens(table, prompt[matched:])
+            running.append([prompt, output_len, table])
+        concurrency.append(len(running))
+        for seq in list(running):
+            if seq not in running:
+                continue
+            try:
+                manager.reserve(seq[2], 1)
+            except OutOfBlocksError:
+                # Recompute preemption: release the newest sequence and requeue
+                # it with everything it has generated so far as its prompt
+                victim = running.pop()
+                tokens = list(victim[2].token_ids)
+                manager.free(victim[2])
+                waiting.insert(0, (tokens, victim[1], BlockTable()))
+                preemptions += 1
+                if victim is seq:
+                    continue
+                manager.reserve(seq[2], 1)
+            manager.append_tokens(seq[2], [len(seq[2].token_ids)])
+            seq[1] -= 1
+        for seq in [s for s in running if s[1] <= 0]:
+            manager.free(seq[2])
+            running.remove(seq)
+    return {"concurrency": concurrency, "preemptions": preemptions}
+
+
+def report(name, result):
+    concurrency = result["concurrency"]
+    print(
+        f"{name:>10}  mean concurrent {statistics.mean(concurrency):7.1f}  "
+        f"peak {max(concurrency):4d}  steps {len(concurrency):6d}  "
+        f"preemptions {result['preemptions']:4d}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--memory-gb", type=float, default=4.0)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--num-requests", type=int, default=500)
+    parser.add_argument("--system-prompt-len", type=int, default=512)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--max-num-seqs", type=int, default=8)
+    args = parser.parse_args()
+
+    num_layers, num_kv_heads, head_dim, dtype_size = DEFAULT_GEOMETRY
+    per_block = PagedKVCache.bytes_per_block(args.block_size, num_layers, num_kv_heads, head_dim, dtype_size)
+    memory_bytes = int(args.memory_gb * 1024 ** 3)
+    capacity = memory_bytes // PagedKVCache.bytes_per_block(1, num_layers, num_kv_heads, head_dim, dtype_size)
+    print(f"KV budget {args.memory_gb} GiB = {capacity} tokens")
+
+    # Longest prompt from build_requests plus its output
+    max_seq_len = args.system_prompt_len + 4096 + args.max_new_tokens
+    workspace = PagedKVCache.workspace_bytes(
+        max_seq_len * args.max_num_seqs, num_kv_heads, head_dim, dtype_size
+    )
+    num_blocks = (memory_bytes - workspace) // per_block
+    print(
+        f"Paged: {workspace / 1024 ** 2:.0f} MiB attention workspace for "
+        f"{args.max_num_seqs} x {max_seq_len} tokens, "
+        f"{num_blocks} blocks of {args.block_size} in the pool"
+    )
+
+    requests = build_requests(args.num_requests, args.system_prompt_len, args.max_new_tokens)
+    report("contiguous", simulate_contiguous(requests, capacity, args.max_new_tokens))
+    report("paged", simulate_paged(requests, num_blocks, args.block_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark service startup: import time and time-to-ready.
+
+Each measurement runs in a fresh interpreter so module caches do not hide
+import cost. Time-to-live is the time until /health answers, time-to-ready
+the time until /ready returns 200.
+
+Usage:
+    python tests/benchmark_startup.py
+    python tests/benchmark_startup.py --target llm-service --runs 5
+    MODEL_NAME_OR_PATH=sshleifer/tiny-gpt2 python tests/benchmark_startup.py --target app
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    # name: (working directory, module to import, uvicorn app path)
+    "app": (ROOT, "app.main", "app.main:app"),
+    "llm-service": (os.path.join(ROOT, "llm-service"), "app", "app:app"),
+}
+
+IMPORT_SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in ("torch", "transformers", "pynvml") if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy_modules": heavy}}))
+"""
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import(cwd, module):
+    """Import the module in a fresh interpreter and return the JSON report."""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def status_of(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return None
+
+
+def measure_ready(cwd, app_path, timeout):
+    """Start uvicorn and return seconds until /health and /ready answer 200."""
+    port = free_port()
+    env = dict(os.environ, METRICS_PORT=str(free_port()))
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app_path, "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    live = ready = None
+    try:
+        base = f"http://127.0.0.1:{port}"
+        while time.perf_counter() - start < timeout and process.poll() is None:
+            if live is None and status_of(f"{base}/health") == 200:
+                live = time.perf_counter() - start
+            if live is not None and status_of(f"{base}/ready") == 200:
+                ready = time.perf_counter() - start
+                break
+            time.sleep(0.05)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return live, ready
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return "n/a"
+    return f"median {statistics.median(values):.3f}s  min {min(values):.3f}s  max {max(values):.3f}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--target", choices=sorted(TARGETS), default="app")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--skip-server", action="store_true", help="Only measure import time")
+    args = parser.parse_args()
+
+    cwd, module, app_path = TARGETS[args.target]
+
+    imports = [measure_import(cwd, module) for _ in range(args.runs)]
+    print(f"import {module}: {summarize([r['seconds'] for r in imports])}")
+    print(f"heavy modules imported: {', '.join(imports[0]['heavy_modules']) or 'none'}")
+
+    if args.skip_server:
+        return
+
+    results = [measure_ready(cwd, app_path, args.timeout) for _ in range(args.runs)]
+    print(f"time to live (/health): {summarize([live for live, _ in results])}")
+    print(f"time to ready (/ready): {summarize([ready for _, ready in results])}")
+    if any(ready is None for _, ready in results):
+        print("note: /ready never returned 200 within the timeout "
+              "(app.main needs MODEL_NAME_OR_PATH to become ready)")
+
+
+if __name__ == "__main__":
+    main()
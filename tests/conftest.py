@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def build_tiny_gpt2(vocab_size=64, max_positions=128, hidden_size=32, num_layers=2, num_heads=2):
+    """Build a randomly initialized GPT-2 that is small enough for CPU."""
+    import torch
+    import transformers
+
+    config = transformers.GPT2Config(
+        vocab_size=vocab_size,
+        n_positions=max_positions,
+        n_embd=hidden_size,
+        n_layer=num_layers,
+        n_head=num_heads,
+    )
+    torch.manual_seed(0)
+    return transformers.GPT2LMHeadModel(config).eval()
+
+
+def build_tiny_llama(vocab_size=64, max_positions=128, hidden_size=32, num_layers=2, num_heads=4,
+                     num_kv_heads=2):
+    """Build a randomly initialized Llama with grouped-query attention that is small enough for CPU."""
+    import torch
+    import transformers
+
+    config = transformers.LlamaConfig(
+        vocab_size=vocab_size,
+        max_position_embeddings=max_positions,
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        num_key_value_heads=num_kv_heads,
+    )
+    torch.manual_seed(0)
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture
+def tiny_gpt2():
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    return build_tiny_gpt2()
+
+
+@pytest.fixture
+def tiny_llama():
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    return build_tiny_llama()
@@ -0,0 +1,283 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.kv_cache import BlockAllocator, BlockManager, BlockTable, OutOfBlocksError
+
+
+def test_allocator_free_list_and_refcounts():
+    allocator = BlockAllocator(2)
+    a = allocator.allocate()
+    b = allocator.allocate()
+    assert allocator.num_free == 0
+    with pytest.raises(OutOfBlocksError):
+        allocator.allocate()
+
+    allocator.incref(a)
+    allocator.free(a)
+    assert allocator.num_free == 0
+    allocator.free(a)
+    allocator.free(b)
+    assert allocator.num_free == 2
+    with pytest.raises(ValueError):
+        allocator.free(b)
+
+
+def test_reserve_allocates_blocks_on_demand():
+    manager = BlockManager(num_blocks=4, block_size=4)
+    table = BlockTable()
+    manager.reserve(table, 5)
+    manager.append_tokens(table, list(range(5)))
+    assert len(table.blocks) == 2
+
+    # The partially filled second block still has room for three tokens
+    manager.reserve(table, 3)
+    assert len(table.blocks) == 2
+    assert manager.occupancy()["used_blocks"] == 2
+
+    manager.free(table)
+    assert manager.occupancy()["free_blocks"] == 4
+
+
+def test_prefix_blocks_are_shared_between_sequences():
+    manager = BlockManager(num_blocks=8, block_size=4)
+    prompt = list(range(10))
+
+    first = BlockTable()
+    manager.reserve(first, len(prompt))
+    manager.append_tokens(first, prompt)
+
+    second = BlockTable()
+    matched = manager.match_prefix(second, prompt)
+    assert matched == 8
+    assert second.blocks == first.blocks[:2]
+    assert manager.occupancy()["shared_blocks"] == 2
+
+    # A different first block breaks the chained hash for every later block
+    third = BlockTable()
+    assert manager.match_prefix(third, [99] + prompt[1:]) == 0
+
+    manager.free(second)
+    assert manager.occupancy()["shared_blocks"] == 0
+
+
+def test_prefix_match_leaves_last_token_to_compute():
+    manager = BlockManager(num_blocks=4, block_size=4)
+    prompt = list(range(8))
+    table = BlockTable()
+    manager.reserve(table, len(prompt))
+    manager.append_tokens(table, prompt)
+
+    assert manager.match_prefix(BlockTable(), prompt) == 4
+
+
+def test_freed_prefix_blocks_can_be_revived_until_reused():
+    manager = BlockManager(num_blocks=3, block_size=4)
+    prompt = list(range(5))
+    table = BlockTable()
+    manager.reserve(table, len(prompt))
+    manager.append_tokens(table, prompt)
+    cached_block = table.blocks[0]
+    manager.free(table)
+
+    revived = BlockTable()
+    assert manager.match_prefix(revived, prompt) == 4
+    assert revived.blocks == [cached_block]
+    manager.free(revived)
+
+    # Allocating every block evicts the cached prefix
+    filler = BlockTable()
+    manager.reserve(filler, 12)
+    manager.free(filler)
+    assert manager.match_prefix(BlockTable(), prompt) == 0
+
+
+def test_cached_prefix_is_evicted_from_its_end():
+    manager = BlockManager(num_blocks=5, block_size=4)
+    prompt = list(range(17))
+    table = BlockTable()
+    manager.reserve(table, len(prompt))
+    manager.append_tokens(table, prompt)
+    manager.free(table)
+
+    # The plain partial block goes first, then the last full block of the prefix
+    other = BlockTable()
+    manager.reserve(other, 8)
+    probe = BlockTable()
+    assert manager.match_prefix(probe, prompt) == 12
+
+
+def test_copy_on_write_splits_shared_partial_block():
+    manager = BlockManager(num_blocks=4, block_size=4)
+    parent = BlockTable()
+    manager.reserve(parent, 6)
+    manager.append_tokens(parent, list(range(6)))
+
+    child = manager.fork(parent)
+    assert child.blocks == parent.blocks
+
+    copies = manager.reserve(child, 1)
+    assert copies == [(parent.blocks[1], child.blocks[1])]
+    assert child.blocks[0] == parent.blocks[0]
+    assert child.blocks[1] != parent.blocks[1]
+
+    # Appending after a block boundary needs no copy
+    manager.append_tokens(child, [6, 7])
+    assert manager.reserve(child, 1) == []
+
+
+def test_reserve_raises_when_pool_is_exhausted():
+    manager = BlockManager(num_blocks=2, block_size=4)
+    table = BlockTable()
+    with pytest.raises(OutOfBlocksError):
+        manager.reserve(table, 9)
+    assert manager.can_allocate(8)
+    assert not manager.can_allocate(9)
+
+
+@pytest.mark.parametrize("model_name", ["tiny_gpt2", "tiny_llama"])
+def test_paged_generation_matches_dynamic_cache(request, model_name):
+    model = request.getfixturevalue(model_name)
+    from app.kv_cache import PagedKVCache
+    from app.paged_attention import supports_paged_attention
+    from app.scheduler import ChunkedPrefillScheduler, Sequence
+
+    kv_cache = PagedKVCache.from_model(model, memory_bytes=192 * 1024, block_size=4)
+    if not supports_paged_attention(model, kv_cache, "cpu"):
+        pytest.skip("this transformers version does not run the model on a Cache object")
+    shared_prefix = list(range(1, 21))
+    prompts = [shared_prefix + [30, 31, 32], shared_prefix + [40, 41], [5, 6, 7]]
+
+    def generate(kv_cache):
+        scheduler = ChunkedPrefillScheduler(model, "cpu", prefill_chunk_size=8, kv_cache=kv_cache)
+        seqs = [scheduler.submit(Sequence(p, max_new_tokens=6, temperature=0)) for p in prompts]
+        scheduler.run_until_complete()
+        assert all(seq.error is None for seq in seqs)
+        return [seq.output_ids for seq in seqs]
+
+    assert generate(kv_cache) == generate(None)
+    assert kv_cache.blocks.occupancy()["used_blocks"] == 0
+
+
+def test_decode_steps_run_as_one_batch(tiny_llama, monkeypatch):
+    import torch
+    from app import scheduler as scheduler_module
+    from app.kv_cache import PagedKVCache
+    from app.paged_attention import supports_paged_attention
+    from app.scheduler import ChunkedPrefillScheduler, Sequence
+
+    model = tiny_llama
+    kv_cache = PagedKVCache.from_model(model, memory_bytes=192 * 1024, block_size=4)
+    if not supports_paged_attention(model, kv_cache, "cpu"):
+        pytest.skip("this transformers version does not run the model on a Cache object")
+    batch_sizes = []
+    paged_forward = scheduler_module.paged_forward
+
+    def recording_forward(model, kv_cache, tables, token_ids, device):
+        batch_sizes.append(len(tables))
+        return paged_forward(model, kv_cache, tables, token_ids, device)
+
+    monkeypatch.setattr(scheduler_module, "paged_forward", recording_forward)
+    scheduler = ChunkedPrefillScheduler(model, "cpu", prefill_chunk_size=0, kv_cache=kv_cache)
+    prompts = [list(range(1, 12)), [5, 6], list(range(20, 27))]
+    seqs = [scheduler.submit(Sequence(p, max_new_tokens=4, temperature=0)) for p in prompts]
+    scheduler.run_until_complete()
+
+    # One prefill per prompt, then three decode steps covering all of them
+    assert batch_sizes == [1, 1, 1, 3, 3, 3]
+    for prompt, seq in zip(prompts, seqs):
+        expected = model.generate(
+            torch.tensor([prompt]), attention_mask=torch.ones(1, len(prompt), dtype=torch.long),
+            max_new_tokens=4, do_sample=False, pad_token_id=0,
+        )
+        assert seq.output_ids == expected[0, len(prompt):].tolist()
+
+
+def test_paged_batch_returns_keys_and_values_where_the_layer_runs():
+    torch = pytest.importorskip("torch")
+    from app.kv_cache import BlockTable, PagedKVCache
+    from app.paged_attention import PagedBatch
+
+    kv_cache = PagedKVCache(num_blocks=4, block_size=4, num_layers=2, num_kv_heads=2, head_dim=8)
+    table = BlockTable()
+    kv_cache.reserve(table, 3)
+    batch = PagedBatch(kv_cache, [table], 3)
+    # A layer running in another dtype stands in for a layer on another device
+    keys = torch.rand(1, 2, 3, 8, dtype=torch.float64)
+    out_keys, out_values = batch.update(keys, keys * 2, layer_idx=1)
+
+    assert out_keys.dtype == out_values.dtype == torch.float64
+    assert out_keys.device == keys.device
+    torch.testing.assert_close(out_keys, keys.float().double())
+    torch.testing.assert_close(out_values, (keys * 2).float().double())
+    assert kv_cache.key_cache.dtype == torch.float32
+
+
+def num_gpus():
+    try:
+        import torch
+    except ImportError:
+        return 0
+    return torch.cuda.device_count()
+
+
+@pytest.mark.skipif(num_gpus() < 2, reason="needs two GPUs")
+def test_paged_generation_with_layers_split_across_devices(tiny_llama):
+    accelerate = pytest.importorskip("accelerate")
+    from app.kv_cache import PagedKVCache
+    from app.paged_attention import supports_paged_attention
+    from app.scheduler import ChunkedPrefillScheduler, Sequence
+
+    model = tiny_llama
+    device_map = {"model.embed_tokens": 0, "model.layers.0": 0, "model.layers.1": 1,
+                  "model.norm": 1, "lm_head": 1}
+    if hasattr(model.model, "rotary_emb"):
+        device_map["model.rotary_emb"] = 0
+    model = accelerate.dispatch_model(model, device_map=device_map)
+    # The pool lives on the first device like in pipeline mode
+    kv_cache = PagedKVCache.from_model(model, memory_bytes=192 * 1024, block_size=4, device="cuda:0")
+    if not supports_paged_attention(model, kv_cache, "cuda:0"):
+        pytest.skip("this transformers version does not run the model on a Cache object")
+
+    def generate(kv_cache):
+        scheduler = ChunkedPrefillScheduler(model, "cuda:0", prefill_chunk_size=8, kv_cache=kv_cache)
+        seqs = [scheduler.submit(Sequence(p, max_new_tokens=6, temperature=0))
+                for p in ([1, 2, 3, 4, 5], list(range(10, 30)))]
+        scheduler.run_until_complete()
+        assert all(seq.error is None for seq in seqs)
+        return [seq.output_ids for seq in seqs]
+
+    assert generate(kv_cache) == generate(None)
+
+
+def test_scheduler_rejects_models_that_bypass_the_cache(tiny_gpt2):
+    from app.kv_cache import PagedKVCache
+    from app.scheduler import ChunkedPrefillScheduler
+
+    model = tiny_gpt2
+    kv_cache = PagedKVCache.from_model(model, memory_bytes=192 * 1024, block_size=4)
+    # A model that never calls Cache.update would silently ignore the pool
+    model.forward = lambda *args, **kwargs: None
+    with pytest.raises(ValueError):
+        ChunkedPrefillScheduler(model, "cpu", kv_cache=kv_cache)
+    assert kv_cache.blocks.occupancy()["used_blocks"] == 0
+
+
+def test_budget_keeps_room_for_the_attention_workspace(tiny_gpt2):
+    from app.kv_cache import PagedKVCache
+
+    model = tiny_gpt2
+    per_token = PagedKVCache.bytes_per_block(1, 2, 2, 16, 4)
+
+    # The workspace holds one of the two layers for 128 positions
+    kv_cache = PagedKVCache.from_model(model, memory_bytes=(64 + 64) * per_token, block_size=4)
+    assert kv_cache.blocks.allocator.num_blocks == 16
+    kv_cache = PagedKVCache.from_model(
+        model, memory_bytes=(2 * 64 + 64) * per_token, block_size=4, max_num_seqs=2
+    )
+    assert kv_cache.blocks.allocator.num_blocks == 16
+    with pytest.raises(ValueError):
+        PagedKVCache.from_model(model, memory_bytes=64 * per_token, block_size=4)
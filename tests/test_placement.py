@@ -0,0 +1,156 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.placement import DeviceSpec, Dispatcher, plan_placement
+
+GB = 1024 ** 3
+
+
+def simulated_devices(count):
+    return [DeviceSpec(i, f"sim-{i}", 24 * GB) for i in range(count)]
+
+
+class FakeLLM:
+    """Stands in for LLMModel: requests stay queued until released."""
+
+    def __init__(self):
+        self.loaded = None
+        self.queue = []
+        self.released = threading.Event()
+        self.scheduler = None
+
+    def load_model(self, model_name_or_path, device_ids=None, max_memory=None):
+        self.loaded = (model_name_or_path, device_ids, max_memory)
+
+    def load(self):
+        return sum(max_length for _, max_length in self.queue)
+
+    def submit(self, prompt, max_length=100, temperature=0.7, top_p=0.9):
+        return self.enqueue(self.prepare(prompt, max_length, temperature, top_p))
+
+    def prepare(self, prompt, max_length=100, temperature=0.7, top_p=0.9):
+        return (prompt, max_length)
+
+    def enqueue(self, seq):
+        self.queue.append(seq)
+        return seq
+
+    def wait(self, seq):
+        self.released.wait()
+        self.queue.remove(seq)
+        return seq[0]
+
+
+def test_replica_mode_places_one_copy_per_device():
+    plans = plan_placement(simulated_devices(4), mode="replica")
+    assert [plan.device_ids for plan in plans] == [[0], [1], [2], [3]]
+    assert all(plan.max_memory is None for plan in plans)
+
+
+def test_pipeline_mode_splits_layers_across_devices():
+    plans = plan_placement(simulated_devices(4), mode="pipeline")
+    assert [plan.device_ids for plan in plans] == [[0, 1, 2, 3]]
+    assert set(plans[0].max_memory) == {0, 1, 2, 3}
+    assert plans[0].max_memory[0] < 24 * GB
+
+
+def test_pipeline_groups_run_as_replicas():
+    plans = plan_placement(simulated_devices(4), mode="pipeline", pipeline_size=2)
+    assert [plan.name for plan in plans] == ["cuda:0,1", "cuda:2,3"]
+
+
+def test_invalid_placements_are_rejected():
+    with pytest.raises(ValueError):
+        plan_placement(simulated_devices(3), mode="pipeline", pipeline_size=2)
+    with pytest.raises(ValueError):
+        plan_placement(simulated_devices(2), mode="tensor")
+
+
+def test_cpu_host_gets_a_single_replica():
+    plans = plan_placement([], mode="replica")
+    assert len(plans) == 1
+    assert plans[0].name == "cpu"
+
+
+def test_dispatcher_loads_each_replica_on_its_devices():
+    dispatcher = Dispatcher(FakeLLM, mode="pipeline", pipeline_size=2)
+    dispatcher.load_model("tiny", devices=simulated_devices(4))
+    loaded = [replica.llm.loaded for replica in dispatcher.replicas]
+    assert [device_ids for _, device_ids, _ in loaded] == [[0, 1], [2, 3]]
+
+
+def test_failed_load_stops_the_replicas_loaded_so_far():
+    class FakeScheduler:
+        stopped = False
+
+        def stop(self):
+            self.stopped = True
+
+    created = []
+
+    def factory():
+        llm = FakeLLM()
+        llm.scheduler = FakeScheduler()
+        if created:
+            def load_model(*args, **kwargs):
+                raise RuntimeError("CUDA out of memory")
+            llm.load_model = load_model
+        created.append(llm)
+        return llm
+
+    dispatcher = Dispatcher(factory, mode="replica")
+    with pytest.raises(RuntimeError):
+        dispatcher.load_model("tiny", devices=simulated_devices(2))
+    assert not dispatcher.is_loaded
+    assert [llm.scheduler.stopped for llm in created] == [True, True]
+
+
+def test_dispatcher_balances_by_outstanding_tokens():
+    dispatcher = Dispatcher(FakeLLM, mode="replica")
+    dispatcher.load_model("tiny", devices=simulated_devices(2))
+    first, second = dispatcher.replicas
+
+    # Idle replicas are used in turn
+    assert dispatcher.select() is first
+    assert dispatcher.select() is second
+
+    first.llm.submit("long", max_length=500)
+    second.llm.submit("short", max_length=10)
+    assert dispatcher.select() is second
+    second.llm.submit("medium", max_length=600)
+    assert dispatcher.select() is first
+
+
+def test_concurrent_requests_spread_over_replicas():
+    dispatcher = Dispatcher(FakeLLM, mode="replica")
+    dispatcher.load_model("tiny", devices=simulated_devices(3))
+
+    threads = [
+        threading.Thread(target=dispatcher.generate, args=(f"p{i}",), kwargs={"max_length": 50}, daemon=True)
+        for i in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while sum(len(replica.llm.queue) for replica in dispatcher.replicas) < 6:
+            assert time.monotonic() < deadline, "requests did not reach the replicas"
+            time.sleep(0.001)
+        assert [len(replica.llm.queue) for replica in dispatcher.replicas] == [2, 2, 2]
+    finally:
+        for replica in dispatcher.replicas:
+            replica.llm.released.set()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+
+
+def test_generate_without_model_raises():
+    with pytest.raises(ValueError):
+        Dispatcher(FakeLLM).generate("hello")
@@ -0,0 +1,235 @@
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.prefix_store import PrefixStore
+
+
+def test_segment_keys_chain_over_the_whole_prefix(tmp_path):
+    store = PrefixStore(str(tmp_path), max_bytes=1 << 20, segment_size=4)
+    keys = list(store.segment_keys("m", list(range(10))))
+    assert [(start, end) for _, _, start, end in keys] == [(0, 4), (4, 8)]
+    assert keys[1][1] == keys[0][0]
+
+    # Same second segment after a different first one gets a different key
+    other = list(store.segment_keys("m", [9, 9, 9, 9] + list(range(4, 8))))
+    assert other[1][0] != keys[1][0]
+    # Keys are scoped to the model
+    assert list(store.segment_keys("n", list(range(4))))[0][0] != keys[0][0]
+
+
+def test_tokens_survive_reopening_and_short_prompts_are_skipped(tmp_path):
+    pytest.importorskip("numpy")
+    store = PrefixStore(str(tmp_path), max_bytes=1 << 20, min_prompt_tokens=8)
+    store.put_tokens("m", "short", [1, 2, 3])
+    store.put_tokens("m", "long", list(range(16)))
+    store.flush()
+
+    reopened = PrefixStore(str(tmp_path), max_bytes=1 << 20, min_prompt_tokens=8)
+    assert reopened.get_tokens("m", "short") is None
+    assert reopened.get_tokens("m", "long") == list(range(16))
+    assert reopened.get_tokens("other-model", "long") is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    pytest.importorskip("numpy")
+    store = PrefixStore(str(tmp_path), max_bytes=1 << 20, min_prompt_tokens=1)
+    for name in ("a", "b"):
+        store.put_tokens("m", name, list(range(100)))
+        store.flush()
+    entry_bytes = store.total_bytes() // 2
+
+    store.max_bytes = 2 * entry_bytes
+    assert store.get_tokens("m", "a") is not None
+    store.put_tokens("m", "c", list(range(100)))
+    store.flush()
+
+    assert store.get_tokens("m", "b") is None
+    assert store.get_tokens("m", "a") is not None
+    assert store.total_bytes() <= store.max_bytes
+
+
+def test_chains_are_evicted_from_their_last_segment(tmp_path):
+    torch = pytest.importorskip("torch")
+    store = PrefixStore(str(tmp_path), max_bytes=1 << 20, segment_size=4)
+    tensor = torch.zeros(2, 2, 4, 8)
+
+    def put(token_ids):
+        for key, parent, start, end in store.segment_keys("m", token_ids):
+            store.put_segment("m", key, parent, token_ids[start:end], tensor, tensor.clone())
+            store.flush()
+
+    chain = list(range(16))
+    put(chain)
+    segment_bytes = store.total_bytes() // 4
+    store.max_bytes = 3 * segment_bytes
+    put([9, 9, 9, 9])
+
+    assert len(store.match_segments("m", chain)) == 2
+    assert len(store.match_segments("m", [9, 9, 9, 9])) == 1
+    # Nothing unreachable is left behind
+    assert len(list(tmp_path.glob("*.pt"))) == 3
+
+    # Dropping a segment takes the segments after it along
+    store.max_bytes = 1 << 20
+    put(chain)
+    first, second = (key for key, _, _ in store.match_segments("m", chain)[:2])
+    store._drop(second)
+    store.flush()
+    assert [key for key, _, _ in store.match_segments("m", chain)] == [first]
+    assert len(list(tmp_path.glob("*.pt"))) == 2
+
+
+def test_snapshots_are_dropped_while_the_writer_is_behind(tmp_path):
+    torch = pytest.importorskip("torch")
+    keys = torch.zeros(2, 2, 4, 8)
+    store = PrefixStore(str(tmp_path), max_bytes=1 << 20, segment_size=4,
+                        max_pending_bytes=2 * keys.numel() * keys.element_size())
+    (a, _, _, _), (b, _, _, _) = store.segment_keys("m", list(range(8)))
+    copied = threading.Event()
+
+    assert store.put_segment("m", a, None, range(4), keys, keys.clone(), ready=copied.wait)
+    assert store.writes_full
+    assert not store.put_segment("m", b, a, range(4, 8), keys, keys.clone())
+    # The writer waits for the copy before saving
+    assert store.total_bytes() == 0
+
+    copied.set()
+    store.flush()
+    assert not store.writes_full
+    assert [key for key, _, _ in store.match_segments("m", list(range(8)))] == [a]
+    assert json.loads((tmp_path / "index.json").read_text()).keys() == {a}
+
+
+def test_warm_restart_restores_prefix_and_matches_cold_output(tmp_path, tiny_gpt2):
+    from app.kv_cache import PagedKVCache
+    from app.paged_attention import supports_paged_attention
+    from app.scheduler import ChunkedPrefillScheduler, Sequence
+
+    model = tiny_gpt2
+    if not supports_paged_attention(model, PagedKVCache.from_model(model, 192 * 1024, block_size=4), "cpu"):
+        pytest.skip("this transformers version does not run the model on a Cache object")
+    prompt = [i % 60 for i in range(40)]
+
+    def run(store, preload=0):
+        kv_cache = PagedKVCache.from_model(model, memory_bytes=192 * 1024, block_size=4)
+        scheduler = ChunkedPrefillScheduler(
+            model, "cpu", prefill_chunk_size=8, kv_cache=kv_cache, prefix_store=store, model_key="tiny"
+        )
+        preloaded = scheduler.preload_prefixes(preload)
+        seq = scheduler.submit(Sequence(prompt, max_new_tokens=5, temperature=0))
+        scheduler.run_until_complete()
+        assert seq.error is None
+        return seq, preloaded
+
+    cold, _ = run(None)
+
+    store = PrefixStore(str(tmp_path), max_bytes=1 << 30, segment_size=16, min_prompt_tokens=16)
+    first, _ = run(store)
+    store.flush()
+    assert first.output_ids == cold.output_ids
+
+    # A new store instance stands in for a restarted process
+    restarted = PrefixStore(str(tmp_path), max_bytes=1 << 30, segment_size=16, min_prompt_tokens=16)
+    warm, _ = run(restarted)
+    assert warm.output_ids == cold.output_ids
+
+    preloaded_seq, preloaded = run(restarted, preload=4)
+    assert preloaded == 32
+    assert preloaded_seq.output_ids == cold.output_ids
+
+
+def test_preload_keeps_the_most_used_prefixes_that_fit(tmp_path, tiny_gpt2):
+    import torch
+    from app.kv_cache import BlockTable, PagedKVCache
+    from app.paged_attention import supports_paged_attention
+    from app.scheduler import ChunkedPrefillScheduler
+
+    model = tiny_gpt2
+    kv_cache = PagedKVCache(num_blocks=2, block_size=4, num_layers=2, num_kv_heads=2, head_dim=16)
+    if not supports_paged_attention(model, kv_cache, "cpu"):
+        pytest.skip("this transformers version does not run the model on a Cache object")
+
+    store = PrefixStore(str(tmp_path), max_bytes=1 << 30, segment_size=4)
+    prompts = {"most": [1, 1, 1, 1], "second": [2, 2, 2, 2], "least": [3, 3, 3, 3]}
+    for uses, token_ids in zip((3, 2, 1), prompts.values()):
+        [(key, parent, _, _)] = store.segment_keys("tiny", token_ids)
+        store.put_segment("tiny", key, parent, token_ids, torch.rand(2, 2, 4, 16), torch.rand(2, 2, 4, 16))
+        store.flush()
+        for _ in range(uses):
+            store.get_segment(key)
+
+    scheduler = ChunkedPrefillScheduler(model, "cpu", kv_cache=kv_cache, prefix_store=store, model_key="tiny")
+    # Only two of the three prefixes fit, the least used one is skipped
+    assert scheduler.preload_prefixes(3) == 8
+
+    def cached(name):
+        table = BlockTable()
+        matched = kv_cache.blocks.match_prefix(table, prompts[name] + [0])
+        kv_cache.free(table)
+        return matched == 4
+
+    # Matching reorders the free list, so allocate first: the block of the
+    # less used prefix is reused before the one of the most used prefix
+    kv_cache.reserve(BlockTable(), 4)
+    assert cached("most")
+    assert not cached("second") and not cached("least")
+
+
+def test_dynamic_cache_snapshots_and_restores_prefixes(tmp_path, tiny_gpt2):
+    from app.scheduler import ChunkedPrefillScheduler, Sequence
+
+    model = tiny_gpt2
+    prompt = [i % 60 for i in range(40)]
+
+    def scheduler_for(store):
+        return ChunkedPrefillScheduler(model, "cpu", prefill_chunk_size=8, prefix_store=store, model_key="tiny")
+
+    cold_scheduler = scheduler_for(None)
+    cold = cold_scheduler.submit(Sequence(prompt, max_new_tokens=5, temperature=0))
+    cold_scheduler.run_until_complete()
+
+    store = PrefixStore(str(tmp_path), max_bytes=1 << 30, segment_size=16, min_prompt_tokens=16)
+    scheduler = scheduler_for(store)
+    assert scheduler.preload_prefixes(4) == 0
+    scheduler.submit(Sequence(prompt, max_new_tokens=5, temperature=0))
+    scheduler.run_until_complete()
+    store.flush()
+
+    restarted = PrefixStore(str(tmp_path), max_bytes=1 << 30, segment_size=16, min_prompt_tokens=16)
+    scheduler = scheduler_for(restarted)
+    warm = scheduler.submit(Sequence(prompt, max_new_tokens=5, temperature=0))
+    # 32 restored tokens leave a single chunk, so the first step already samples
+    scheduler.step()
+    assert len(warm.output_ids) == 1
+    scheduler.run_until_complete()
+    assert warm.error is None
+    assert warm.output_ids == cold.output_ids
+
+
+def test_model_fingerprint_changes_with_local_files(tmp_path, monkeypatch):
+    from app import model as model_module
+
+    (tmp_path / "config.json").write_text('{"n_layer": 2}')
+    (tmp_path / "tokenizer.json").write_text('{"vocab": {"a": 0}}')
+    (tmp_path / "model.safetensors").write_bytes(b"\0" * 32)
+    monkeypatch.setattr(model_module, "FINGERPRINT_CONTENT_LIMIT", 16)
+
+    def fingerprint():
+        return model_module.model_fingerprint(str(tmp_path), config=None)
+
+    original = fingerprint()
+    assert fingerprint() == original
+
+    (tmp_path / "tokenizer.json").write_text('{"vocab": {"b": 0}}')
+    retokenized = fingerprint()
+    assert retokenized != original
+
+    # Large weight files are compared by size and modification time
+    (tmp_path / "model.safetensors").write_bytes(b"\1" * 48)
+    assert fingerprint() != retokenized
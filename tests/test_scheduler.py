@@ -0,0 +1,96 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.scheduler import ChunkedPrefillScheduler, Sequence, sample_next_token
+
+
+@pytest.fixture
+def model(tiny_gpt2):
+    return tiny_gpt2
+
+
+def run(model, prompts, max_new_tokens, prefill_chunk_size):
+    scheduler = ChunkedPrefillScheduler(model, "cpu", prefill_chunk_size=prefill_chunk_size)
+    seqs = [
+        scheduler.submit(Sequence(prompt, max_new_tokens=max_new_tokens, temperature=0))
+        for prompt in prompts
+    ]
+    scheduler.run_until_complete()
+    for seq in seqs:
+        assert seq.error is None
+    return [seq.output_ids for seq in seqs]
+
+
+def test_greedy_sampling_picks_the_most_likely_token():
+    logits = torch.tensor([0.1, 5.0, 0.3, 0.2])
+    assert sample_next_token(logits, temperature=0) == 1
+    # A small top_p keeps only the most likely token
+    assert all(sample_next_token(logits, temperature=1.0, top_p=0.1) == 1 for _ in range(20))
+
+
+@pytest.mark.parametrize("prefill_chunk_size", [1, 3, 8, 16])
+def test_chunked_prefill_matches_unchunked_and_hf_generate(model, prefill_chunk_size):
+    prompts = [[i % 60 for i in range(40)], [5, 9, 2], list(range(17))]
+    unchunked = run(model, prompts, max_new_tokens=6, prefill_chunk_size=0)
+    assert run(model, prompts, max_new_tokens=6, prefill_chunk_size=prefill_chunk_size) == unchunked
+
+    for prompt, output_ids in zip(prompts, unchunked):
+        expected = model.generate(
+            torch.tensor([prompt]),
+            attention_mask=torch.ones(1, len(prompt), dtype=torch.long),
+            max_new_tokens=6,
+            do_sample=False,
+            pad_token_id=0,
+        )
+        assert output_ids == expected[0, len(prompt):].tolist()
+
+
+def test_decoding_continues_while_a_long_prompt_prefills(model):
+    scheduler = ChunkedPrefillScheduler(model, "cpu", prefill_chunk_size=8)
+    short = scheduler.submit(Sequence([1, 2, 3], max_new_tokens=20, temperature=0))
+    scheduler.step()
+    assert len(short.output_ids) == 1
+
+    long = scheduler.submit(Sequence([i % 60 for i in range(64)], max_new_tokens=4, temperature=0))
+    for step in range(1, 4):
+        scheduler.step()
+        assert len(short.output_ids) == 1 + step
+        assert long.is_prefilling
+        assert long.num_computed == 8 * step
+
+
+def test_zero_max_new_tokens_generates_nothing(model):
+    assert run(model, [[1, 2, 3]], max_new_tokens=0, prefill_chunk_size=8) == [[]]
+
+
+def test_loop_survives_a_failed_step(model):
+    scheduler = ChunkedPrefillScheduler(model, "cpu", prefill_chunk_size=8)
+    step = scheduler.step
+    failures = []
+
+    def failing_step():
+        if not failures:
+            failures.append(RuntimeError("broken bookkeeping"))
+            raise failures[0]
+        step()
+
+    scheduler.step = failing_step
+    scheduler.start()
+    try:
+        failed = scheduler.submit(Sequence([1, 2, 3], max_new_tokens=2, temperature=0))
+        assert failed.done.wait(timeout=10)
+        assert failed.error is failures[0]
+
+        seq = scheduler.submit(Sequence([1, 2, 3], max_new_tokens=2, temperature=0))
+        assert seq.done.wait(timeout=10)
+        assert seq.error is None
+        assert len(seq.output_ids) == 2
+    finally:
+        scheduler.stop()